@@ -1,57 +1,348 @@
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+from keras import layers
 from keras.callbacks import EarlyStopping, ModelCheckpoint
-from keras.preprocessing.image import ImageDataGenerator
 from keras.applications.mobilenet import MobileNet
 from keras.applications.mobilenet import preprocess_input
+from keras.models import Sequential
+
+from generator import keras_fgs
 
 # dimensions of images.
 img_width, img_height = 224, 224
+batch_size = 32
+# decoded images held for shuffling after the cache, bounds its memory
+shuffle_buffer = 1024
 
 train_data_dir = 'data/training_set'
 validation_data_dir = 'data/test_set'
-model_path = 'results/models/baseModel.h5'
-
-data_generator = ImageDataGenerator(preprocessing_function=preprocess_input)
-
-train_generator = data_generator.flow_from_directory(
-        train_data_dir,
-        target_size=(img_width, img_height),
-        color_mode='rgb',
-        batch_size=32,
-        class_mode='categorical',
-        shuffle=True)
-
-validation_generator = data_generator.flow_from_directory(
-        validation_data_dir,
-        target_size=(img_width, img_height),
-        color_mode='rgb',
-        batch_size=32,
-        class_mode='categorical',
-        shuffle=True)
-
-call_backs = []
-call_backs.append(ModelCheckpoint('result/models/checkpoints/mobile_net.h5',
-                                save_weights_only=True))
-call_backs.append(EarlyStopping(patience=3))
-
-model = MobileNet(input_shape=(img_width, img_height, 3), weights=None, classes=2)
-
-model.compile(loss='categorical_crossentropy',
-              optimizer='adam',
-              metrics=['accuracy'])
-
-num_epochs = 20
-
-step_size_train = train_generator.n//train_generator.batch_size
-nb_validation_samples = validation_generator.n//validation_generator.batch_size
-
-model.fit_generator(
-        generator=train_generator,
-        steps_per_epoch=step_size_train,
-        epochs=num_epochs,
-        validation_data=validation_generator,
-        nb_val_samples=nb_validation_samples,
-        callbacks=call_backs
-)
-
-model.save_weights(model_path)
-print(model.evaluate_generator(validation_generator))
\ No newline at end of file
+model_path = 'results/models/baseModel.weights.h5'
+# pretrained backbone with a head trained on cached features
+feature_model_path = 'results/models/featureModel.weights.h5'
+# MobileNet trained on clean and replayed adversarial images
+robust_model_path = 'results/models/robustModel.weights.h5'
+# decoded and resized images, written during the first epoch and read by
+# every later one
+cache_dir = 'results/cache'
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+def list_images(data_dir):
+    """
+    Return the image paths, class indices and class names of a directory
+    with one subdirectory per class, classes are indexed in sorted order
+    like flow_from_directory does
+    """
+    classes = sorted(d for d in os.listdir(data_dir) if os.path.isdir(os.path.join(data_dir, d)))
+    paths, labels = [], []
+    for i, cls in enumerate(classes):
+        class_dir = os.path.join(data_dir, cls)
+        for filename in sorted(os.listdir(class_dir)):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.join(class_dir, filename))
+                labels.append(i)
+    return paths, labels, classes
+
+
+def cache_prefix(paths):
+    """
+    Path prefix of the decoded-image cache of a list of images, any added,
+    removed or modified image or a different image size selects a new cache
+    """
+    key = hashlib.sha1('{}x{}'.format(img_width, img_height).encode())
+    for path in paths:
+        stat = os.stat(path)
+        key.update('|{}|{}|{}'.format(path, stat.st_mtime_ns, stat.st_size).encode())
+    return os.path.join(cache_dir, key.hexdigest())
+
+
+def image_key(path):
+    """
+    Cache key of a single image, changes whenever the image file or the
+    image size changes
+    """
+    stat = os.stat(path)
+    key = '{}|{}|{}|{}x{}'.format(os.path.abspath(path), stat.st_mtime_ns, stat.st_size,
+                                  img_width, img_height)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def decode_image(path, label):
+    image = tf.io.decode_image(tf.io.read_file(path), channels=3, expand_animations=False)
+    image = tf.image.resize(image, (img_height, img_width))
+    # Cached as uint8 to keep the cache four times smaller than floats
+    return tf.cast(tf.round(image), tf.uint8), label
+
+
+def load_dataset(data_dir, shuffle):
+    """
+    Build the input pipeline of a data directory, images are decoded and
+    resized in parallel once, cached on disk and then only shuffled,
+    batched and normalized in every epoch while the model trains on the
+    previous batch
+
+    The full shuffle happens on the (path, label) pairs before the cache,
+    the decoded images only pass through a bounded shuffle buffer, so
+    memory does not grow with the dataset.
+    """
+    paths, labels, classes = list_images(data_dir)
+    if not paths:
+        raise ValueError('No images in {}'.format(data_dir))
+    os.makedirs(cache_dir, exist_ok=True)
+    dataset = tf.data.Dataset.from_tensor_slices((paths, labels))
+    if shuffle:
+        # The cache replays the order of the epoch that wrote it
+        dataset = dataset.shuffle(len(paths), reshuffle_each_iteration=False)
+    dataset = dataset.map(decode_image, num_parallel_calls=tf.data.AUTOTUNE)
+    dataset = dataset.cache(cache_prefix(paths))
+    if shuffle:
+        dataset = dataset.shuffle(shuffle_buffer, reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(lambda images, labels: (preprocess_input(tf.cast(images, tf.float32)),
+                                                  tf.one_hot(labels, len(classes))),
+                          num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def build_backbone():
+    """
+    ImageNet-pretrained MobileNet without its top, returns one pooled
+    embedding per image
+    """
+    return MobileNet(input_shape=(img_width, img_height, 3), weights='imagenet',
+                     include_top=False, pooling='avg')
+
+
+def build_head(num_features, num_classes):
+    return Sequential([
+        layers.Input(shape=(num_features,)),
+        layers.Dropout(0.2),
+        layers.Dense(num_classes, activation='softmax')
+    ])
+
+
+def load_features(backbone, data_dir):
+    """
+    Return the pooled embeddings of every image of a data directory
+    together with its class indices
+
+    Embeddings are cached per image in an append-only memory-mapped file
+    with a JSON index from image key to row, shared by all data
+    directories. The backbone only runs over images that are new or changed
+    since they were last embedded. Rows of changed images are not reclaimed,
+    remove the cache directory to compact it.
+    """
+    paths, labels, classes = list_images(data_dir)
+    num_features = backbone.output_shape[-1]
+    store_path = os.path.join(cache_dir, '{}-features.f32'.format(backbone.name))
+    index_path = os.path.join(cache_dir, '{}-features.json'.format(backbone.name))
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+    rows = max(index.values()) + 1 if index else 0
+    keys = [image_key(path) for path in paths]
+
+    missing = [(path, key) for path, key in zip(paths, keys) if key not in index]
+    if missing:
+        os.makedirs(cache_dir, exist_ok=True)
+        dataset = tf.data.Dataset.from_tensor_slices([path for path, _ in missing])
+        dataset = dataset.map(lambda path: preprocess_input(tf.cast(decode_image(path, 0)[0],
+                                                                    tf.float32)),
+                              num_parallel_calls=tf.data.AUTOTUNE)
+        dataset = dataset.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+        with open(store_path, 'ab') as f:
+            # Drop rows of an interrupted run that never made it into the index
+            f.truncate(rows * num_features * 4)
+            for images in dataset:
+                f.write(backbone(images, training=False).numpy().astype(np.float32).tobytes())
+        for _, key in missing:
+            index[key] = rows
+            rows += 1
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, index_path)
+
+    store = np.memmap(store_path, dtype=np.float32, mode='r', shape=(rows, num_features))
+    return store[[index[key] for key in keys]], np.array(labels), len(classes)
+
+
+def train_full(num_epochs=20):
+    """
+    Train MobileNet from scratch on the images
+    """
+    train_dataset = load_dataset(train_data_dir, shuffle=True)
+    validation_dataset = load_dataset(validation_data_dir, shuffle=False)
+
+    call_backs = []
+    call_backs.append(ModelCheckpoint('results/models/checkpoints/mobile_net.weights.h5',
+                                      save_weights_only=True))
+    call_backs.append(EarlyStopping(patience=3))
+
+    model = MobileNet(input_shape=(img_width, img_height, 3), weights=None, classes=2)
+
+    model.compile(loss='categorical_crossentropy',
+                  optimizer='adam',
+                  metrics=['accuracy'])
+
+    model.fit(
+            train_dataset,
+            epochs=num_epochs,
+            validation_data=validation_dataset,
+            callbacks=call_backs
+    )
+
+    os.makedirs(os.path.dirname(model_path), exist_ok=True)
+    model.save_weights(model_path)
+    print(model.evaluate(validation_dataset))
+
+
+class ReplayBuffer:
+    """
+    Bounded ring buffer of adversarial images and their labels, the oldest
+    entries are replaced first
+
+    Parameters:
+    -----------
+    size: int
+        Maximum number of adversarial images
+    num_classes: int
+        Length of the one-hot labels
+    """
+
+    def __init__(self, size, num_classes):
+        # float16 halves the memory of the buffer, preprocessed images lie
+        # in [-1, 1] where its precision is ample
+        self._images = np.empty((size, img_height, img_width, 3), dtype=np.float16)
+        self._labels = np.empty((size, num_classes), dtype=np.float32)
+        self._next = 0
+        self.count = 0
+
+    def add(self, images, labels):
+        for image, label in zip(images, labels):
+            self._images[self._next] = image
+            self._labels[self._next] = label
+            self._next = (self._next + 1) % len(self._images)
+            self.count = min(self.count + 1, len(self._images))
+
+    def sample(self, n):
+        # Drawn with replacement, a young buffer still fills the batch
+        index = np.random.randint(0, self.count, size=n)
+        return self._images[index].astype(np.float32), self._labels[index]
+
+
+def train_adversarial(num_epochs=20, buffer_size=512, replay=0.5, refresh=0.25, alpha=0.02,
+                      iterations=1):
+    """
+    Train MobileNet from scratch on clean images mixed with adversarials
+    replayed from a bounded buffer
+
+    Every step keeps the batch size of plain training: a replay fraction of
+    the clean batch is swapped for adversarials sampled from the buffer.
+    Only a refresh fraction of the swapped-out clean images is attacked with
+    an untargeted keras_fgs attack on the current model to refresh the
+    buffer, so with the defaults a step attacks 4 of 32 images once and
+    costs about 1.1 plain training steps.
+
+    Parameters:
+    -----------
+    num_epochs: int
+        Number of epochs (default: 20)
+    buffer_size: int
+        Maximum number of adversarials kept for replay (default: 512)
+    replay: float
+        Fraction of every batch made of replayed adversarials (default: 0.5)
+    refresh: float
+        Fraction of the replayed images of a step that is attacked afresh
+        (default: 0.25)
+    alpha: float
+        FGS step size in preprocessed [-1, 1] units (default: 0.02)
+    iterations: int
+        FGS iterations per refreshed image (default: 1)
+    """
+    train_dataset = load_dataset(train_data_dir, shuffle=True)
+    validation_dataset = load_dataset(validation_data_dir, shuffle=False)
+
+    model = MobileNet(input_shape=(img_width, img_height, 3), weights=None, classes=2)
+    model.compile(loss='categorical_crossentropy',
+                  optimizer='adam',
+                  metrics=['accuracy'])
+    buffer = ReplayBuffer(buffer_size, model.output_shape[-1])
+
+    for epoch in range(num_epochs):
+        metrics = None
+        for images, labels in train_dataset:
+            images, labels = images.numpy(), labels.numpy()
+            kept = len(images) - max(1, int(replay * len(images)))
+            refreshed = slice(kept, kept + max(1, int(refresh * (len(images) - kept))))
+            adversarials = keras_fgs.fgs(model, images[refreshed], labels[refreshed].argmax(1),
+                                         alpha=alpha, iterations=iterations, reg=0.0)
+            buffer.add(adversarials.numpy(), labels[refreshed])
+            replayed_images, replayed_labels = buffer.sample(len(images) - kept)
+            metrics = model.train_on_batch(np.concatenate([images[:kept], replayed_images]),
+                                           np.concatenate([labels[:kept], replayed_labels]))
+        print('Epoch {}/{}: train {}, validation {}'.format(
+            epoch + 1, num_epochs, metrics, model.evaluate(validation_dataset, verbose=0)))
+
+    os.makedirs(os.path.dirname(robust_model_path), exist_ok=True)
+    model.save_weights(robust_model_path)
+
+
+def train_head(num_epochs=20):
+    """
+    Train only a classification head on pooled embeddings of the frozen
+    pretrained backbone, cached on disk so that retraining after a dataset
+    change only embeds the new or changed images
+    """
+    backbone = build_backbone()
+    train_features, train_labels, num_classes = load_features(backbone, train_data_dir)
+    validation_features, validation_labels, _ = load_features(backbone, validation_data_dir)
+
+    head = build_head(train_features.shape[1], num_classes)
+    head.compile(loss='categorical_crossentropy',
+                 optimizer='adam',
+                 metrics=['accuracy'])
+    head.fit(
+            train_features, np.eye(num_classes)[train_labels],
+            batch_size=batch_size,
+            epochs=num_epochs,
+            shuffle=True,
+            validation_data=(validation_features, np.eye(num_classes)[validation_labels]),
+            callbacks=[EarlyStopping(patience=3, restore_best_weights=True)]
+    )
+
+    # Backbone and head together classify images like baseModel.weights.h5 does
+    model = Sequential([backbone, head])
+    os.makedirs(os.path.dirname(feature_model_path), exist_ok=True)
+    model.save_weights(feature_model_path)
+    print(head.evaluate(validation_features, np.eye(num_classes)[validation_labels]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train the image classifier')
+    parser.add_argument('--mode', choices=['full', 'features', 'adversarial'], default='full',
+                        help='train MobileNet from scratch, only a head on cached features '
+                             'of the pretrained backbone or MobileNet on clean and replayed '
+                             'adversarial images')
+    parser.add_argument('--epochs', type=int, default=20)
+    parser.add_argument('--buffer-size', type=int, default=512,
+                        help='adversarial replay buffer size in adversarial mode')
+    parser.add_argument('--replay', type=float, default=0.5,
+                        help='fraction of every batch made of replayed adversarials')
+    parser.add_argument('--refresh', type=float, default=0.25,
+                        help='fraction of the replayed images attacked afresh every step')
+    args = parser.parse_args()
+
+    if args.mode == 'features':
+        train_head(args.epochs)
+    elif args.mode == 'adversarial':
+        train_adversarial(args.epochs, args.buffer_size, args.replay, args.refresh)
+    else:
+        train_full(args.epochs)
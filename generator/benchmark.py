@@ -0,0 +1,159 @@
+import argparse
+import copy
+import os
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torchvision import models
+
+from generator import fgs
+from generator import util
+from generator import weights
+from generator.main import ATTACK_PARAMS, CACHE_DIR, MODEL_NAME, netImageLabels
+
+TESTER_IMAGES = os.path.join(os.path.dirname(__file__), '..', 'tester_images')
+
+
+def _timeit(fn, repeats):
+    """
+    Run fn once as a warm-up and return the median wall time of the next
+    repeats runs in seconds
+    """
+    fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def _print_results(title, results, images):
+    print(title)
+    for name, seconds in results.items():
+        print('  {:<24} {:8.3f} s  {:8.2f} images/s'.format(name, seconds, images / seconds))
+
+
+def _weight_grad_fgs(model, input_image, label, alpha, iterations, reg):
+    """
+    Reference attack loop calling loss.backward() on a model with trainable
+    parameters, as fgs did before input-only gradients
+    """
+    crit = nn.CrossEntropyLoss()
+    img_var = input_image.clone().requires_grad_(True)
+    for _ in range(iterations):
+        img_var.grad = None
+        loss = crit(model(img_var), label) + reg * F.mse_loss(img_var, input_image)
+        loss.backward()
+        img_var.data = img_var.data - alpha * torch.sign(img_var.grad.data)
+    return img_var.detach()
+
+
+def bench_input_gradient(batch_size=16, iterations=3, repeats=3):
+    """
+    Compare attacks that also compute ResNet-34 weight gradients with attacks
+    on a frozen model that compute only the input gradient
+
+    Parameters
+    ----------
+    batch_size: int
+        Number of images attacked at once (default: 16)
+    iterations: int
+        FGS iterations per attack (default: 3)
+    repeats: int
+        Number of timed runs, the median is reported (default: 3)
+    """
+    model = models.resnet34().eval()
+    frozen = fgs.prepare_model(copy.deepcopy(model), use_cuda=False)
+    images = torch.randn(batch_size, 3, 224, 224)
+    labels = torch.randint(0, 1000, (batch_size,))
+    results = {
+        'weight gradients': _timeit(
+            lambda: _weight_grad_fgs(model, images, labels, 0.01, iterations, 1e-2), repeats),
+        'input gradient only': _timeit(
+            lambda: fgs.fgs(frozen, images, labels, targeted=True, alpha=0.01,
+                            iterations=iterations, use_cuda=False, prepared=True), repeats),
+    }
+    grad_bytes = sum(p.grad.numel() * p.grad.element_size()
+                     for p in model.parameters() if p.grad is not None)
+    _print_results('Input-only gradients, batch {}, {} iterations'.format(batch_size, iterations),
+                   results, batch_size)
+    print('  weight grad buffers avoided: {:.1f} MB'.format(grad_bytes / 2 ** 20))
+    return results
+
+
+def _load_tester_images(images_path, limit=None):
+    """
+    Load the original images of every class directory of images_path,
+    returns the normalized batch and the target label of each image (the
+    other class of the two)
+    """
+    classes = sorted(d for d in os.listdir(images_path)
+                     if os.path.isdir(os.path.join(images_path, d)) and not d.endswith('_adv'))
+    tensors, targets = [], []
+    for i, cls in enumerate(classes):
+        target = netImageLabels[classes[1 - i]]
+        class_dir = os.path.join(images_path, cls)
+        for filename in sorted(os.listdir(class_dir))[:limit]:
+            tensors.append(util.preprocess(util.load_image(os.path.join(class_dir, filename))))
+            targets.append(target)
+    return torch.cat(tensors), torch.tensor(targets)
+
+
+def bench_bfloat16(images_path=TESTER_IMAGES, batch_size=16, limit=None):
+    """
+    Compare attack throughput and success rate of fp32 and bfloat16 autocast
+    attacks on the tester images, success is judged by an fp32 forward pass
+
+    Parameters
+    ----------
+    images_path: str
+        Directory with one subdirectory of original images per class
+        (default: tester_images)
+    batch_size: int
+        Number of images attacked at once (default: 16)
+    limit: int
+        Maximum number of images per class (default: None, all)
+    """
+    images, targets = _load_tester_images(images_path, limit)
+    model = weights.load_pretrained(MODEL_NAME, CACHE_DIR)
+    sessions = {
+        'fp32': fgs.AttackSession(model),
+        'bfloat16': fgs.AttackSession(model, bfloat16=True),
+    }
+    results, success = {}, {}
+    for name, session in sessions.items():
+        start = time.perf_counter()
+        adversarial = torch.cat([
+            session.attack(images[i:i + batch_size], targets[i:i + batch_size],
+                           targeted=True, **ATTACK_PARAMS)
+            for i in range(0, len(images), batch_size)])
+        results[name] = time.perf_counter() - start
+        pred, _ = sessions['fp32'].classify(adversarial)
+        success[name] = pred == targets
+    _print_results('bfloat16 autocast attack, {} images, batch {}'.format(len(images), batch_size),
+                   results, len(images))
+    for name, hits in success.items():
+        print('  {:<24} success rate {:.3f}'.format(name, hits.float().mean().item()))
+    agreement = (success['fp32'] == success['bfloat16']).float().mean().item()
+    print('  per-image success agreement {:.3f}'.format(agreement))
+    return results, success
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generator benchmarks')
+    parser.add_argument('benchmark', choices=['input-grad', 'bfloat16'])
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--iterations', type=int, default=3)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--images-path', default=TESTER_IMAGES)
+    parser.add_argument('--limit', type=int, default=None,
+                        help='maximum number of images per class')
+    args = parser.parse_args()
+
+    if args.benchmark == 'input-grad':
+        bench_input_gradient(args.batch_size, args.iterations, args.repeats)
+    elif args.benchmark == 'bfloat16':
+        bench_bfloat16(args.images_path, args.batch_size, args.limit)
@@ -0,0 +1,183 @@
+import json
+import os
+import sqlite3
+import threading
+
+from PIL import Image
+
+from generator import manifest
+
+DEFAULT_PATH = os.path.join(os.path.dirname(__file__), 'cache', 'catalog.sqlite')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg')
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    dir TEXT NOT NULL,
+    name TEXT NOT NULL,
+    class TEXT,
+    original INTEGER,
+    width INTEGER,
+    height INTEGER,
+    sha256 TEXT,
+    mtime REAL,
+    size INTEGER,
+    params TEXT
+);
+CREATE INDEX IF NOT EXISTS images_dir ON images (dir);
+CREATE INDEX IF NOT EXISTS images_class ON images (class, original);
+'''
+
+_COLUMNS = ('path', 'dir', 'name', 'class', 'original', 'width', 'height',
+            'sha256', 'mtime', 'size', 'params')
+
+
+class Catalog:
+    """
+    SQLite catalogue of source and generated images shared by the generator
+    and the tester
+
+    Every image is stored with its class, original/adversarial flag,
+    dimensions, content hash and, for generated images, the generation
+    parameters. Writers keep the entries fresh: the generator syncs the
+    directories it reads and adds every image it writes. A sync stats the
+    files of a directory and only opens and hashes files whose mtime or
+    size changed. Readers such as the tester only query.
+
+    Parameters:
+    -----------
+    path: str
+        Database file (default: generator/cache/catalog.sqlite)
+    """
+
+    def __init__(self, path=DEFAULT_PATH):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _row(self, path, cls, original, stat):
+        with Image.open(path) as im:
+            width, height = im.size
+        return {'path': path, 'dir': os.path.dirname(path), 'name': os.path.basename(path),
+                'class': cls, 'original': int(original), 'width': width, 'height': height,
+                'sha256': manifest.file_hash(path), 'mtime': stat.st_mtime,
+                'size': stat.st_size}
+
+    def _upsert(self, row, params=None):
+        # Attributes of known files are refreshed, generation parameters are
+        # only replaced when new ones are given
+        self._conn.execute(
+            'INSERT INTO images (path, dir, name, class, original, width, height, sha256, '
+            'mtime, size, params) VALUES (:path, :dir, :name, :class, :original, :width, '
+            ':height, :sha256, :mtime, :size, :params) '
+            'ON CONFLICT (path) DO UPDATE SET class = excluded.class, '
+            'original = excluded.original, width = excluded.width, height = excluded.height, '
+            'sha256 = excluded.sha256, mtime = excluded.mtime, size = excluded.size, '
+            'params = COALESCE(excluded.params, images.params)',
+            dict(row, params=json.dumps(params, sort_keys=True) if params is not None else None))
+
+    def sync_directory(self, dir_path, cls, original):
+        """
+        Bring the entries of the images directly inside dir_path up to date,
+        only files whose mtime or size changed since the last sync are read
+
+        The mtime of the directory itself is not enough to skip the scan,
+        rewriting a file in place does not change it.
+
+        Parameters:
+        -----------
+        dir_path: str
+            Directory of images
+        cls: str
+            Class of the images
+        original: bool
+            Whether the images are originals or adversarials
+        """
+        dir_path = os.path.abspath(dir_path)
+        with self._lock:
+            rows = {path: (file_mtime, size) for path, file_mtime, size in self._conn.execute(
+                'SELECT path, mtime, size FROM images WHERE dir = ?', (dir_path,))}
+            present = set()
+            for entry in os.scandir(dir_path):
+                if not entry.is_file() or not entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                present.add(entry.path)
+                stat = entry.stat()
+                if rows.get(entry.path) != (stat.st_mtime, stat.st_size):
+                    self._upsert(self._row(entry.path, cls, original, stat))
+            self._conn.executemany('DELETE FROM images WHERE path = ?',
+                                   [(path,) for path in rows if path not in present])
+            self._conn.commit()
+
+    def add(self, path, cls, original, params=None):
+        """
+        Record a single image, e.g. right after the generator wrote it
+
+        Parameters:
+        -----------
+        path: str
+            Image file
+        cls: str
+            Class of the image
+        original: bool
+            Whether the image is an original or an adversarial
+        params: dict
+            Generation parameters (default: None, keep the recorded ones)
+        """
+        path = os.path.abspath(path)
+        row = self._row(path, cls, original, os.stat(path))
+        with self._lock:
+            self._upsert(row, params)
+            self._conn.commit()
+
+    def get(self, path):
+        """
+        Return the entry of an image as a dict, None if it is not catalogued
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT {} FROM images WHERE path = ?'.format(', '.join(_COLUMNS)),
+                                     (os.path.abspath(path),)).fetchone()
+        if row is None:
+            return None
+        entry = dict(zip(_COLUMNS, row))
+        entry['params'] = json.loads(entry['params']) if entry['params'] is not None else None
+        return entry
+
+    def list_images(self, dir_path, cls, original):
+        """
+        Sync dir_path and return the names of its images in sorted order
+        """
+        self.sync_directory(dir_path, cls, original)
+        with self._lock:
+            return [name for name, in self._conn.execute(
+                'SELECT name FROM images WHERE dir = ? ORDER BY name',
+                (os.path.abspath(dir_path),))]
+
+    def query(self, cls=None, original=None, dir_path=None):
+        """
+        Return the paths of all catalogued images in sorted order, optionally
+        filtered by class, original/adversarial flag and directory, without
+        touching the file system
+        """
+        conditions, args = [], []
+        if dir_path is not None:
+            conditions.append('dir = ?')
+            args.append(os.path.abspath(dir_path))
+        if cls is not None:
+            conditions.append('class = ?')
+            args.append(cls)
+        if original is not None:
+            conditions.append('original = ?')
+            args.append(int(original))
+        sql = 'SELECT path FROM images'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        with self._lock:
+            return [path for path, in self._conn.execute(sql + ' ORDER BY path', args)]
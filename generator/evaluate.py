@@ -0,0 +1,124 @@
+import argparse
+import os
+
+from generator import fgs
+from generator import imagenet_labels
+from generator import pipeline
+from generator import util
+from generator.catalog import IMAGE_EXTENSIONS
+from generator.main import IMAGES_OUT, load_model
+
+
+def list_images(path):
+    """
+    Return the paths of all images below path in sorted order
+    """
+    paths = []
+    for dir_path, dir_names, filenames in os.walk(path):
+        dir_names.sort()
+        paths.extend(os.path.join(dir_path, filename) for filename in sorted(filenames)
+                     if filename.lower().endswith(IMAGE_EXTENSIONS))
+    return paths
+
+
+def classify_tensors(session, images, k=5):
+    """
+    Classify a batch of normalized images and return, for every image, a
+    list of its k most likely (label, probability) pairs
+
+    Parameters:
+    -----------
+    session: AttackSession
+        Session of the classifying model
+    images: torch.Tensor
+        N x 3 x H x W batch of normalized images
+    k: int
+        Number of classes reported per image (default: 5)
+    """
+    probs, preds = session.topk(images, k)
+    return [[(imagenet_labels.label(pred), prob)
+             for pred, prob in zip(image_preds.tolist(), image_probs.tolist())]
+            for image_preds, image_probs in zip(preds, probs)]
+
+
+def map_batches(fn, paths, batch_size=64, decode_workers=4, width=224, height=224):
+    """
+    Decode image files into normalized batches and apply fn to each batch
+    while the next ones are decoded, returns a list of (path, result) pairs
+    in input order
+
+    Parameters:
+    -----------
+    fn: callable
+        Turns an N x 3 x height x width batch into a sequence of N per-image
+        results, the batch is overwritten once fn returns
+    paths: iterable
+        Image files, consumed lazily
+    batch_size: int
+        Number of images passed to fn at once (default: 64)
+    decode_workers: int
+        Number of image decoding threads (default: 4)
+    width: int
+        Width the images are resized to (default: 224)
+    height: int
+        Height the images are resized to (default: 224)
+    """
+    buffer = util.BatchBuffer(width, height)
+    results = {}
+
+    def decode(item):
+        index, path = item
+        return index, path, util.load_image(path, width, height)
+
+    def apply(items):
+        outputs = fn(buffer.fill([img for _, _, img in items]))
+        return [(index, path, output) for (index, path, _), output in zip(items, outputs)]
+
+    def collect(item):
+        index, path, output = item
+        results[index] = (path, output)
+
+    # Decoding threads deliver images out of order, results are put back
+    # into input order at the end
+    pipeline.run_pipeline(enumerate(paths), decode, apply, collect, batch_size=batch_size,
+                          decode_workers=decode_workers, encode_workers=1,
+                          queue_size=4 * batch_size)
+    return [results[index] for index in sorted(results)]
+
+
+def classify_paths(session, paths, k=5, batch_size=64, decode_workers=4):
+    """
+    Classify image files in batches while the next ones are decoded, returns
+    a list of (path, topk) pairs in input order, topk as returned by
+    classify_tensors
+    """
+    return map_batches(lambda batch: classify_tensors(session, batch, k), paths,
+                       batch_size, decode_workers)
+
+
+def classify_directory(session, path=IMAGES_OUT, k=5, batch_size=64, decode_workers=4):
+    """
+    Classify every image below path, by default all generated originals and
+    adversarials
+    """
+    return classify_paths(session, list_images(path), k, batch_size, decode_workers)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Classify a directory tree of images')
+    parser.add_argument('path', nargs='?', default=IMAGES_OUT,
+                        help='directory of images (default: generator/images_out)')
+    parser.add_argument('--top', type=int, default=5,
+                        help='number of classes reported per image')
+    parser.add_argument('--batch-size', type=int, default=64,
+                        help='number of images classified at once')
+    parser.add_argument('--decode-workers', type=int, default=4,
+                        help='number of image decoding threads')
+    args = parser.parse_args()
+
+    session = fgs.AttackSession(load_model(), use_cuda=False)
+    for image_path, topk in classify_directory(session, args.path, args.top, args.batch_size,
+                                               args.decode_workers):
+        print('{}: {}'.format(os.path.relpath(image_path, args.path),
+                              ', '.join('{} {:.2f}%'.format(label, prob * 100)
+                                        for label, prob in topk)))
@@ -1,51 +1,45 @@
 import fgs
 import imagenet_labels
-from PIL import Image
 #sudo apt-get install python3-tk
 import matplotlib
 matplotlib.use("TkAgg")
 import matplotlib.pyplot as plt
 import numpy as np
-from torchvision import models
-import torch
-import torch.nn.functional as F
 import util
+import weights
 
 
 
-def classify(model, im):
+def classify(session, im):
     """
-    Classify the image with model and return the label and class
-    probability
+    Classify the image with the attack session model and return the label
+    and class probability
     """
-    device = torch.device("cpu")
-    model.to(device)
-    im = im.to(device)
-    model.eval()
-    out = model(im)
-    label = imagenet_labels.label(out.argmax().item())
-    prob = F.softmax(out, dim=1)
-    return label, round((torch.max(prob.data, 1)[0].item()) * 100, 2)
+    pred, prob = session.classify(im)
+    label = imagenet_labels.label(pred[0].item())
+    return label, round(prob[0].item() * 100, 2)
 
 
-# Load pretrained model
-model = models.resnet34(pretrained=True)
+# Load pretrained model from the generator's weight cache
+session = fgs.AttackSession(weights.load_pretrained("resnet34", "cache"), use_cuda=False)
 
 # Load and classify image
-im = Image.open("47909_adv.jpg")  # taken from ImageNet test set
-im = im.resize((224, 224), Image.ANTIALIAS)
-true_label, true_prob = classify(model, util.preprocess(im))
+im = util.load_image("47909_adv.jpg")  # taken from ImageNet test set
+true_label, true_prob = classify(session, util.preprocess(im))
 print("True label: {}, prob: {}".format(true_label, true_prob))
 
 # Generate adversarial example that will correspond to target_class
 target_class = 245
 print("Target class:", imagenet_labels.label(target_class))
-adverserial_image = fgs.fgs(model, util.preprocess(im), target_class,
-                            targeted=True, alpha=0.01, iterations=10,
-                            use_cuda=False)
+adverserial_image, outcome = session.attack(util.preprocess(im), target_class,
+                                            targeted=True, alpha=0.01, iterations=10,
+                                            report=True)
 adverserial_image = util.postprocess(adverserial_image)
-adv_label, adv_prob = classify(model, util.preprocess(adverserial_image))
-print("Predicted label: {}, prob: {}".format(adv_label, adv_prob))
+# Prediction and target probability come from the attack itself, no extra
+# classification of the adverserial image is needed
+adv_label = imagenet_labels.label(outcome['pred'][0].item())
+adv_prob = round(outcome['confidence'][0].item() * 100, 2)
+print("Predicted label: {}, target prob: {}".format(adv_label, adv_prob))
 
 
 # Plot results
@@ -3,28 +3,97 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+try:
+    from generator import util
+except ImportError:
+    # Imported flat next to util, as by example.py
+    import util
+
+
+def _per_sample(value, n, dtype, device):
+    """
+    Broadcast a scalar or a sequence of per-sample values into a 1D tensor
+    of length n
+    """
+    if torch.is_tensor(value):
+        value = value.to(device=device, dtype=dtype).reshape(-1)
+    else:
+        value = torch.as_tensor(np.asarray(value), dtype=dtype, device=device).reshape(-1)
+    if value.numel() == 1:
+        value = value.expand(n)
+    if value.numel() != n:
+        raise ValueError('Expected 1 or {} values, got {}'.format(n, value.numel()))
+    return value
+
+
+def prepare_model(model, use_cuda=True):
+    """
+    Prepare model for attacks once: move it to the device, switch it to
+    evaluation mode and freeze its parameters so that only input gradients
+    are computed
+
+    Parameters
+    ----------
+    model: torch.nn.Module
+        PyTorch pretrained model with weights already loaded
+    use_cuda: bool
+        Try to use CUDA if available
+    """
+    device = torch.device('cuda' if use_cuda else 'cpu')
+    model.to(device)
+    model.eval()
+    for param in model.parameters():
+        param.requires_grad_(False)
+    return model
+
+
+def _converged(out, label_var, direction, stop, threshold):
+    """
+    Evaluate the early stopping criterion for every sample of the batch
+    """
+    targeted = direction < 0
+    label_logit = out.gather(1, label_var.unsqueeze(1)).squeeze(1)
+    other_logit = out.scatter(1, label_var.unsqueeze(1), float('-inf')).max(1)[0]
+    if stop == 'label':
+        return torch.where(targeted, label_logit > other_logit, other_logit > label_logit)
+    if stop == 'margin':
+        margin = torch.where(targeted, label_logit - other_logit, other_logit - label_logit)
+        return margin >= threshold
+    if stop == 'confidence':
+        prob = F.softmax(out, dim=1)
+        label_prob = prob.gather(1, label_var.unsqueeze(1)).squeeze(1)
+        other_prob = prob.scatter(1, label_var.unsqueeze(1), 0.0).max(1)[0]
+        return torch.where(targeted, label_prob, other_prob) >= threshold
+    raise ValueError('Unknown stopping criterion: {}'.format(stop))
+
 
 def fgs(model, input_image, label, targeted=False, alpha=0.02, iterations=1,
         reg=1e-2, clamp=((-2.118, -2.036, -1.804), (2.249, 2.429, 2.64)),
-        use_cuda=True):
+        use_cuda=True, stop=None, threshold=0.0, prepared=False, bfloat16=False,
+        report=False):
     """
     Fast gradient sign method for generating adverserial attack examples
 
+    The whole batch is perturbed with a single forward/backward pass per
+    iteration. Labels, targeted flags and step sizes can be given either
+    once for the whole batch or per sample.
+
     Parameters
     ----------
     model: torch.nn.Module
         PyTorch pretrained model with weights already loaded
     input_image: PyTorch 4D Tensor
-        Initial image that is to be modified for adverserial attack
-    label: int
+        Batch of N initial images that are to be modified for adverserial
+        attack
+    label: int or sequence of N ints
         True label of the input_image if untargeted attack
-        (adverserial image will be classified into this label)
+        (adverserial image will not be classified into this label)
         OR
         Desired label of input_image if targeted attack
-        (adverserial image will not be classified into this label)
-    targeted: bool
+        (adverserial image will be classified into this label)
+    targeted: bool or sequence of N bools
         Whether targeted or untargeted attack (default: False)
-    alpha: float
+    alpha: float or sequence of N floats
         Step size for updating image with sign of gradient (default: 0.02)
     iterations: int
         Number of iterations to repeat the algorithm (default: 1)
@@ -37,29 +106,226 @@ def fgs(model, input_image, label, targeted=False, alpha=0.02, iterations=1,
         Set to (None, None) to avoid clamping
     use_cuda: bool
         Try to use CUDA if available
+    stop: str or None
+        Early stopping criterion evaluated on every forward pass, samples that
+        meet it are dropped from the working batch (default: None, always run
+        all iterations). One of:
+        'label' - image is classified as the target (targeted) or no longer
+        classified as the true label (untargeted)
+        'confidence' - softmax probability of the target class (targeted) or
+        of the best other class (untargeted) reaches threshold
+        'margin' - logit margin of the target class over the best other
+        class (targeted) or of the best other class over the true label
+        (untargeted) reaches threshold
+    threshold: float
+        Threshold for the 'confidence' and 'margin' criteria (default: 0.0)
+    prepared: bool
+        Model was already frozen and moved to the device with prepare_model,
+        skip the per-call setup (default: False)
+    bfloat16: bool
+        Run the model forward and backward passes under bfloat16 autocast,
+        the adverserial image itself is still updated and clamped in fp32
+        (default: False)
+    report: bool
+        Also return a dict of per-sample attack outcomes (default: False):
+        'pred' - predicted class of the adverserial image
+        'confidence' - softmax probability of label for the adverserial image
+        'iterations' - number of steps applied before the sample stopped
+        'success' - adverserial image is classified as label (targeted) or
+        not as label (untargeted)
+        Samples that stopped early are reported from the logits of the
+        forward pass that stopped them, only the samples that ran all
+        iterations need one extra forward pass without gradients
     """
     device = torch.device('cuda' if use_cuda else 'cpu')
-    model.to(device)
-    model.eval()
-    crit = nn.CrossEntropyLoss().to(device)
-    input_image = input_image.to(device)
-    img_var = input_image.clone().requires_grad_(True).to(device)
-    label_var = torch.LongTensor([label]).to(device)
-    for _ in range(iterations):
-        img_var.grad = None
-        out = model(img_var)
-        # Cross entropy + MSE regularization between adverserial and original image
-        loss = crit(out, label_var) + reg * F.mse_loss(img_var, input_image)
-        # loss = F.nll_loss(out, label_var)
-        loss.backward()
-        noise = alpha * torch.sign(img_var.grad.data)
-        if targeted:
-            img_var.data = img_var.data - noise
+    if not prepared:
+        model.to(device)
+        model.eval()
+    crit = nn.CrossEntropyLoss(reduction='none').to(device)
+    if clamp[0] is not None and clamp[1] is not None:
+        assert len(clamp[0]) == len(clamp[1])
+        clamp_min = torch.tensor(clamp[0], device=device).view(1, -1, 1, 1)
+        clamp_max = torch.tensor(clamp[1], device=device).view(1, -1, 1, 1)
+    else:
+        clamp_min = clamp_max = None
+    return _fgs_loop(model, crit, input_image.to(device), label, targeted, alpha,
+                     iterations, reg, clamp_min, clamp_max, stop, threshold, bfloat16,
+                     report)
+
+
+def _record_outcome(outcome, index, out, label_var, steps):
+    """
+    Store the prediction, label probability and step count of the samples at
+    index from their logits
+    """
+    prob = F.softmax(out, dim=1)
+    outcome['pred'][index] = prob.argmax(1)
+    outcome['confidence'][index] = prob.gather(1, label_var.unsqueeze(1)).squeeze(1)
+    outcome['iterations'][index] = steps
+
+
+def _fgs_loop(model, crit, input_image, label, targeted, alpha, iterations, reg,
+              clamp_min, clamp_max, stop, threshold, bfloat16=False, report=False):
+    """
+    Attack loop shared by fgs and AttackSession, expects the model, loss,
+    clamp bounds and input_image to be on the same device already
+    """
+    device = input_image.device
+    n = input_image.size(0)
+    label_var = _per_sample(label, n, torch.long, device)
+    # Targeted attacks descend the loss, untargeted ones ascend it
+    direction = 1.0 - 2.0 * _per_sample(targeted, n, torch.bool, device).to(input_image.dtype)
+    step = (direction * _per_sample(alpha, n, input_image.dtype, device)).view(-1, 1, 1, 1)
+    result = torch.empty_like(input_image)
+    if report:
+        outcome = {'pred': torch.empty(n, dtype=torch.long, device=device),
+                   'confidence': torch.empty(n, device=device),
+                   'iterations': torch.empty(n, dtype=torch.long, device=device)}
+        all_labels, all_targeted = label_var, direction < 0
+    # Working batch holding only the samples that have not converged yet
+    active = torch.arange(n, device=device)
+    img_var = input_image.clone()
+    for i in range(iterations):
+        img_var.requires_grad_(True)
+        with util.stage('forward'), torch.autocast(device_type=device.type, dtype=torch.bfloat16,
+                                               enabled=bfloat16):
+            out = model(img_var)
+        out = out.float()
+        # Cross entropy + MSE regularization between adverserial and original
+        # image, computed per sample so that the step of one image does not
+        # depend on the rest of the batch
+        mse = (img_var - input_image).pow(2).flatten(1).mean(1)
+        loss = crit(out, label_var) + reg * mse
+        keep = None
+        if stop is not None:
+            done = _converged(out.detach(), label_var, direction, stop, threshold)
+            if done.any():
+                keep = ~done
+                result[active[done]] = img_var.detach()[done]
+                if report:
+                    _record_outcome(outcome, active[done], out.detach()[done],
+                                    label_var[done], i)
+                if not keep.any():
+                    active = active[keep]
+                    break
+                loss = loss[keep]
+        # Only the input gradient is requested, weight gradients of a frozen
+        # model are neither computed nor accumulated
+        with util.stage('backward'):
+            grad, = torch.autograd.grad(loss.sum(), img_var)
+        with util.stage('step'):
+            img_var = img_var.detach() + step * torch.sign(grad)
+            # Clamp image into valid range
+            if clamp_min is not None:
+                img_var.clamp_(clamp_min, clamp_max)
+        if keep is not None:
+            img_var, input_image = img_var[keep], input_image[keep]
+            label_var, direction, step = label_var[keep], direction[keep], step[keep]
+            active = active[keep]
+    if active.numel() > 0:
+        result[active] = img_var.detach()
+        if report:
+            # The last step of the remaining samples was never evaluated
+            with util.stage('forward'), torch.no_grad(), torch.autocast(
+                    device_type=device.type, dtype=torch.bfloat16, enabled=bfloat16):
+                out = model(img_var.detach())
+            _record_outcome(outcome, active, out.float(), label_var, iterations)
+    if not report:
+        return result.cpu()
+    outcome['success'] = torch.where(all_targeted, outcome['pred'] == all_labels,
+                                     outcome['pred'] != all_labels)
+    return result.cpu(), {key: value.cpu() for key, value in outcome.items()}
+
+
+class AttackSession:
+    """
+    Long-lived attack context that prepares the model once and owns the
+    device, loss and preallocated clamp/normalization tensors, so that each
+    call only pays for the attack math
+
+    Parameters
+    ----------
+    model: torch.nn.Module
+        PyTorch pretrained model with weights already loaded
+    use_cuda: bool
+        Try to use CUDA if available (default: False)
+    mean: tuple of floats
+        Mean of the pixels used for normalization
+        (default: [0.485, 0.456, 0.406] from ImageNet)
+    std: tuple of floats
+        Standard deviation of the pixels used for normalization
+        (default: [0.229, 0.224, 0.225] from ImageNet)
+    clamp: bool
+        Clamp adverserial images into the range of normalized [0, 1] pixels
+        after each iteration (default: True)
+    bfloat16: bool
+        Run attack forward and backward passes under bfloat16 autocast
+        (default: False)
+    channels_last: bool
+        Feed images to the model in channels-last memory format, usually
+        faster for convolutional models on CPU (default: False)
+    """
+
+    def __init__(self, model, use_cuda=False, mean=(0.485, 0.456, 0.406),
+                 std=(0.229, 0.224, 0.225), clamp=True, bfloat16=False,
+                 channels_last=False):
+        self.device = torch.device('cuda' if use_cuda else 'cpu')
+        self.bfloat16 = bfloat16
+        self.memory_format = torch.channels_last if channels_last else torch.contiguous_format
+        self.model = prepare_model(model, use_cuda)
+        self.crit = nn.CrossEntropyLoss(reduction='none').to(self.device)
+        self.mean = torch.tensor(mean, device=self.device).view(1, -1, 1, 1)
+        self.std = torch.tensor(std, device=self.device).view(1, -1, 1, 1)
+        if clamp:
+            self.clamp_min = (0.0 - self.mean) / self.std
+            self.clamp_max = (1.0 - self.mean) / self.std
         else:
-            img_var.data = img_var.data + noise
-        # Clamp image into valid range
-        if clamp[0] is not None and clamp[1] is not None:
-            assert len(clamp[0]) == len(clamp[1])
-            for ch in range(len(clamp[0])):
-                img_var.data[:, ch, :, :].clamp_(clamp[0][ch], clamp[1][ch])
-    return img_var.cpu().detach()
+            self.clamp_min = self.clamp_max = None
+
+    def normalize(self, images):
+        """
+        Normalize a batch of [0, 1] images on the session device
+        """
+        return (images.to(self.device) - self.mean) / self.std
+
+    def denormalize(self, images):
+        """
+        Map a batch of normalized images back into [0, 1] on the session device
+        """
+        return images.to(self.device) * self.std + self.mean
+
+    def attack(self, images, label, targeted=False, alpha=0.02, iterations=1,
+               reg=1e-2, stop=None, threshold=0.0, report=False):
+        """
+        Generate adverserial examples for a batch of normalized images,
+        see fgs for the meaning of the parameters
+        """
+        images = images.to(self.device, memory_format=self.memory_format)
+        return _fgs_loop(self.model, self.crit, images, label,
+                         targeted, alpha, iterations, reg, self.clamp_min,
+                         self.clamp_max, stop, threshold, self.bfloat16, report)
+
+    def classify(self, images):
+        """
+        Classify a batch of normalized images, returns the predicted class
+        indices and their probabilities
+        """
+        prob, pred = self.topk(images, k=1)
+        return pred[:, 0], prob[:, 0]
+
+    def logits(self, images):
+        """
+        Return the fp32 logits of a batch of normalized images, computed
+        without building an autograd graph
+        """
+        with util.stage('classify'), torch.inference_mode():
+            out = self.model(images.to(self.device, memory_format=self.memory_format))
+        return out.float().cpu()
+
+    def topk(self, images, k=5):
+        """
+        Classify a batch of normalized images without building an autograd
+        graph, returns the probabilities and class indices of the k most
+        likely classes of every image, both of shape N x k
+        """
+        return F.softmax(self.logits(images), dim=1).topk(k, dim=1)
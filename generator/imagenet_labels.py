@@ -1,3 +1,5 @@
+import re
+
 # Taken from: gist.github.com/maraoz/388eddec39d60c6d52d4
 _labels = {
  0: 'tench, Tinca tinca',
@@ -1014,3 +1016,54 @@ def label(index):
         Class index 
     """
     return _labels.get(index, "Unknown")
+
+
+# Lower-case synonym -> class index and word -> class indices, built on
+# first use
+_names = None
+_words = None
+
+
+def _build_index():
+    global _names, _words
+    names, words = {}, {}
+    for index, labels in _labels.items():
+        for name in labels.split(', '):
+            names.setdefault(name.lower(), index)
+            for word in re.findall(r'[a-z0-9]+', name.lower()):
+                words.setdefault(word, set()).add(index)
+    _names, _words = names, words
+
+
+def index(name):
+    """
+    Returns the ImageNet class index of a label synonym, e.g. 'hot dog',
+    or None if no class has that name
+
+    Parameters:
+    -----------
+    name: str
+        Synonym of the class, case-insensitive
+    """
+    if _names is None:
+        _build_index()
+    return _names.get(name.lower())
+
+
+def search(keyword):
+    """
+    Returns the sorted ImageNet class indices whose label contains every
+    word of keyword as a whole word, e.g. 'terrier' or 'ice cream'
+
+    Parameters:
+    -----------
+    keyword: str
+        One or more words, case-insensitive
+    """
+    if _words is None:
+        _build_index()
+    words = re.findall(r'[a-z0-9]+', keyword.lower())
+    if not words:
+        return []
+    matches = set.intersection(*(_words.get(word, set()) for word in words))
+    return sorted(matches)
@@ -0,0 +1,184 @@
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+from keras.applications.mobilenet import MobileNet
+from PIL import Image
+
+BASE_MODEL_PATH = os.path.join(os.path.dirname(__file__), '..', 'results', 'models',
+                               'baseModel.weights.h5')
+
+
+def load_model(path=BASE_MODEL_PATH, num_classes=2, width=224, height=224):
+    """
+    Rebuild the MobileNet trained by classification.py and load its saved
+    weights
+
+    Parameters:
+    -----------
+    path: str
+        Weights file (default: results/models/baseModel.weights.h5)
+    num_classes: int
+        Number of classes the model was trained on (default: 2)
+    width: int
+        Input width (default: 224)
+    height: int
+        Input height (default: 224)
+    """
+    model = MobileNet(input_shape=(height, width, 3), weights=None, classes=num_classes)
+    model.load_weights(path)
+    model.trainable = False
+    return model
+
+
+def load_image(path, width=224, height=224):
+    """
+    Decode an image into width x height x 3 uint8 pixels, like
+    generator.util.load_image but without pulling in PyTorch
+    """
+    im = Image.open(path)
+    im.draft('RGB', (width, height))
+    im = im.convert('RGB')
+    if im.size != (width, height):
+        im = im.resize((width, height), Image.LANCZOS)
+    return np.array(im)
+
+
+def preprocess(pixels):
+    """
+    Map N x H x W x 3 uint8 pixels into the [-1, 1] range of MobileNet's
+    preprocess_input
+    """
+    return tf.cast(pixels, tf.float32) / 127.5 - 1.0
+
+
+def postprocess(images):
+    """
+    Map a batch of [-1, 1] images back into uint8 pixels
+    """
+    pixels = np.rint((np.asarray(images) + 1.0) * 127.5)
+    return np.clip(pixels, 0, 255).astype(np.uint8)
+
+
+def _per_sample(value, n, dtype):
+    value = tf.reshape(tf.cast(value, dtype), [-1])
+    return tf.broadcast_to(value, [n])
+
+
+@tf.function
+def _fgs_loop(model, images, labels, direction, alpha, iterations, reg, clamp_min, clamp_max,
+              stop):
+    step = tf.reshape(direction * alpha, [-1, 1, 1, 1])
+    active = tf.ones_like(alpha, dtype=tf.bool)
+    adversarials = images
+    for _ in tf.range(iterations):
+        with tf.GradientTape() as tape:
+            tape.watch(adversarials)
+            out = model(adversarials, training=False)
+            # Cross entropy + MSE regularization per sample, summed so that
+            # the step of one image does not depend on the rest of the batch
+            mse = tf.reduce_mean(tf.square(adversarials - images), axis=[1, 2, 3])
+            loss = tf.reduce_sum(tf.keras.losses.sparse_categorical_crossentropy(labels, out) +
+                                 reg * mse)
+        if stop:
+            # Converged samples keep the image they converged with
+            pred = tf.argmax(out, axis=1, output_type=labels.dtype)
+            active = active & tf.where(direction < 0, pred != labels, pred == labels)
+        grad = tape.gradient(loss, adversarials)
+        update = step * tf.sign(grad) * tf.reshape(tf.cast(active, grad.dtype), [-1, 1, 1, 1])
+        adversarials = tf.clip_by_value(adversarials + update, clamp_min, clamp_max)
+    return adversarials
+
+
+def fgs(model, input_image, label, targeted=False, alpha=0.02, iterations=1, reg=1e-2,
+        clamp=(-1.0, 1.0), stop=None):
+    """
+    Fast gradient sign method against a Keras model, the counterpart of
+    generator.fgs.fgs for batches of N x H x W x 3 images in the [-1, 1]
+    range of MobileNet's preprocess_input
+
+    Input gradients of the whole batch are computed with one GradientTape
+    per iteration inside a single tf.function, weights are never
+    differentiated.
+
+    Parameters:
+    -----------
+    model: keras.Model
+        Classifier with a softmax output
+    input_image: array or tf.Tensor
+        Batch of N preprocessed images
+    label: int or sequence of N ints
+        True label (untargeted) or desired label (targeted) of every image
+    targeted: bool or sequence of N bools
+        Whether targeted or untargeted attack (default: False)
+    alpha: float or sequence of N floats
+        Step size for updating image with sign of gradient (default: 0.02)
+    iterations: int
+        Number of iterations to repeat the algorithm (default: 1)
+    reg: float
+        MSE regularization to keep adverserial and original image close
+        (default: 1e-2)
+    clamp: tuple
+        Min and max values the image is clamped to after each iteration
+        (default: the preprocess_input range), (None, None) to avoid clamping
+    stop: str or None
+        'label' to stop updating images as soon as they are classified as
+        the target (targeted) or no longer as the true label (untargeted)
+        (default: None, always run all iterations)
+    """
+    if stop not in (None, 'label'):
+        raise ValueError('Unknown stopping criterion: {}'.format(stop))
+    images = tf.convert_to_tensor(input_image, dtype=tf.float32)
+    n = images.shape[0]
+    labels = _per_sample(label, n, tf.int64)
+    # Targeted attacks descend the loss, untargeted ones ascend it
+    direction = 1.0 - 2.0 * _per_sample(targeted, n, tf.float32)
+    clamp_min = clamp[0] if clamp[0] is not None else -np.inf
+    clamp_max = clamp[1] if clamp[1] is not None else np.inf
+    return _fgs_loop(model, images, labels, direction, _per_sample(alpha, n, tf.float32),
+                     tf.constant(iterations), tf.constant(reg, tf.float32),
+                     tf.constant(clamp_min, tf.float32), tf.constant(clamp_max, tf.float32),
+                     stop is not None)
+
+
+def attack_directory(model, src_dir, out_dir, target, batch_size=32, decode_workers=4,
+                     alpha=0.02, iterations=10, reg=1e-2, width=224, height=224):
+    """
+    Attack every image of src_dir towards the target class of the Keras
+    model in batches and write the adverserials into out_dir under the same
+    names
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    filenames = sorted(f for f in os.listdir(src_dir) if os.path.isfile(os.path.join(src_dir, f)))
+
+    def decode(filename):
+        return load_image(os.path.join(src_dir, filename), width, height)
+
+    with ThreadPoolExecutor(decode_workers) as executor:
+        for start in range(0, len(filenames), batch_size):
+            names = filenames[start:start + batch_size]
+            pixels = np.stack(list(executor.map(decode, names)))
+            adversarials = fgs(model, preprocess(pixels), target, targeted=True, alpha=alpha,
+                               iterations=iterations, reg=reg, stop='label')
+            adversarial_pixels = postprocess(adversarials)
+            list(executor.map(lambda i: Image.fromarray(adversarial_pixels[i]).save(
+                os.path.join(out_dir, names[i])), range(len(names))))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Attack the Keras model trained by '
+                                                 'classification.py')
+    parser.add_argument('src_dir', help='directory of images to attack')
+    parser.add_argument('out_dir', help='directory the adverserials are written to')
+    parser.add_argument('target', type=int,
+                        help='target class index, classes are in sorted directory order')
+    parser.add_argument('--model', default=BASE_MODEL_PATH, help='weights file')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--alpha', type=float, default=0.02)
+    parser.add_argument('--iterations', type=int, default=10)
+    args = parser.parse_args()
+
+    attack_directory(load_model(args.model), args.src_dir, args.out_dir, args.target,
+                     args.batch_size, alpha=args.alpha, iterations=args.iterations)
@@ -1,11 +1,23 @@
-import threading
-from concurrent.futures import ThreadPoolExecutor
+import argparse
+import functools
+import itertools
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+import numpy as np
+import torch
 from PIL import Image
+from generator import catalog
 from generator import fgs
-from torchvision import models
 import os, os.path
+from generator import manifest
+from generator import pipeline
+from generator import profiler
+from generator import store
+from generator import tensor_cache
 from generator import util
+from generator import weights
 
 netImageLabels = {
     'cat': 282,  # tiger cat
@@ -16,57 +28,463 @@ netImageLabels = {
     'icecream': 928
 }
 
-model = models.resnet34(pretrained=True)
-
 IMAGES_PATH = os.path.join(os.path.dirname(__file__), 'images')
 IMAGES_OUT = os.path.join(os.path.dirname(__file__), 'images_out')
 ADV_SUFFIX = '_adv'
+MANIFEST_PATH = os.path.join(IMAGES_OUT, 'manifest.jsonl')
+SHARDS_PATH = os.path.join(IMAGES_OUT, 'shards')
+CACHE_DIR = os.path.join(os.path.dirname(__file__), 'cache')
+TENSOR_CACHE_PATH = os.path.join(CACHE_DIR, 'images')
+# Everything util.load_image output depends on besides the source file
+PREPROCESS_PARAMS = ('draft-lanczos', 224, 224)
+# Per-image targets chosen by generator.planner
+PLAN_PATH = os.path.join(CACHE_DIR, 'plan.json')
+
+MODEL_NAME = 'resnet34'
+ATTACK_PARAMS = {
+    'alpha': 0.01,
+    'iterations': 10,
+    'reg': 1e-2,
+    'stop': 'label'
+}
 
-lock = threading.RLock()
+# Attack session of the current process, every worker loads its own replica
+session = None
+# Batch tensor reused by every attack_batch call of the current process
+_batch_buffer = util.BatchBuffer()
+# Image catalogue, only opened by the process that lists jobs
+_catalog = None
+# Cache of decoded and resized source images, disabled unless init_worker
+# is given a size
+_tensor_cache = None
 
 
-def generate_adversarial_image(dir_path, filename, target_label, label):
+def get_catalog():
+    """
+    Return the image catalogue shared with the tester, opened on first use
+    """
+    global _catalog
+    if _catalog is None:
+        _catalog = catalog.Catalog()
+    return _catalog
+
+
+def load_model():
+    """
+    Return the attacked model with weights from the local cache
+    """
+    return weights.load_pretrained(MODEL_NAME, CACHE_DIR)
+
+
+def init_worker(num_threads=None, bfloat16=False, cache_bytes=0):
+    """
+    Load the attack model once for the current process
+
+    Parameters:
+    -----------
+    num_threads: int
+        Number of intra-op threads torch may use in this process
+        (default: None, keep the torch default)
+    bfloat16: bool
+        Attack under bfloat16 autocast (default: False)
+    cache_bytes: int
+        Size cap of the on-disk cache of decoded source images
+        (default: 0, no cache)
+    """
+    global session, _tensor_cache
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    if cache_bytes > 0:
+        _tensor_cache = tensor_cache.TensorCache(TENSOR_CACHE_PATH, cache_bytes)
+    session = fgs.AttackSession(load_model(), use_cuda=False, bfloat16=bfloat16)
+
+
+def get_session():
+    """
+    Return the attack session of the current process, the model is only
+    loaded on first use
+    """
+    if session is None:
+        init_worker()
+    return session
+
+
+def load_plan(path=PLAN_PATH):
+    """
+    Return the per-image targets written by generator.planner, a dict
+    mapping source paths relative to IMAGES_PATH to ImageNet class indices
+    """
+    with open(path) as f:
+        return json.load(f)
+
+
+def target_class(target_label):
+    """
+    ImageNet class index of a job target, either a label of netImageLabels
+    or a class index chosen by the planner
+    """
+    return target_label if isinstance(target_label, int) else netImageLabels[target_label]
+
+
+def list_jobs(images_path=IMAGES_PATH, plan=None):
+    """
+    Yield (dir_path, filename, target_label, label) for every source image,
+    each image is attacked towards the other label of its group unless plan
+    maps its path relative to images_path to a target class index
+    """
+    plan = plan or {}
+    for group in os.listdir(images_path):
+        group_dir = os.path.join(images_path, group)
+        labels = os.listdir(group_dir)
+
+        label_dir = [os.path.join(group_dir, labels[0]), os.path.join(group_dir, labels[1])]
+
+        for i in range(2):
+            for image in get_catalog().list_images(label_dir[i], labels[i], True):
+                source = os.path.relpath(os.path.join(label_dir[i], image), images_path)
+                yield label_dir[i], image, plan.get(source, labels[1 - i]), labels[i]
+
+
+def load_image(job):
+    """
+    Decode the source image of a job at the attack resolution
+    """
+    dir_path, filename, target_label, label = job
     print(filename)
 
     image_path = os.path.join(dir_path, filename)
-    img = Image.open(image_path)
-    img = img.resize((224, 224), Image.ANTIALIAS)
+    if _tensor_cache is not None:
+        with util.stage('cache get'):
+            pixels = _tensor_cache.get(image_path, PREPROCESS_PARAMS)
+        if pixels is not None:
+            return job, Image.fromarray(np.asarray(pixels))
+
+    img = util.load_image(image_path, PREPROCESS_PARAMS[1], PREPROCESS_PARAMS[2])
+    if _tensor_cache is not None:
+        with util.stage('cache put'):
+            _tensor_cache.put(image_path, PREPROCESS_PARAMS, np.asarray(img))
+    return job, img
+
+
+def log_outcomes(jobs, outcome):
+    """
+    Print one success table row per attacked job from the attack report
+    """
+    for i, (dir_path, filename, target_label, label) in enumerate(jobs):
+        print('{:<24} {:>10} -> {:<10} pred {:>4} target prob {:6.2f}% iterations {:>3} {}'.format(
+            filename, label, target_label, outcome['pred'][i].item(),
+            outcome['confidence'][i].item() * 100, outcome['iterations'][i].item(),
+            'success' if outcome['success'][i] else 'failed'))
+
+
+def attack_batch(items):
+    """
+    Attack a list of loaded images with one batched call, each towards the
+    target label of its job
+    """
+    tensors = _batch_buffer.fill([img for _, img in items])
+    targets = [target_class(job[2]) for job, _ in items]
+    with util.stage('attack'):
+        adversarial_tensors, outcome = get_session().attack(tensors, targets, targeted=True,
+                                                            report=True, **ATTACK_PARAMS)
+    if util.timer is not None:
+        util.timer.count('images', len(items))
+    log_outcomes([job for job, _ in items], outcome)
+    adversarial_pixels = util.postprocess_batch(adversarial_tensors)
+    return [(job, img, adversarial_pixels[i], adversarial_tensors[i])
+            for i, (job, img) in enumerate(items)]
+
 
-    tensor = util.preprocess(img)
+def attack_job(job):
+    """
+    Load and attack the source image of a single job
+    """
+    return attack_batch([load_image(job)])[0]
 
-    with lock:
-        adversarial_tensor = fgs.fgs(model, tensor, netImageLabels[target_label],
-                                     targeted=True, alpha=0.01, iterations=10,
-                                     use_cuda=False)
 
-    adversarial_image = util.postprocess(adversarial_tensor)
+def save_images(item):
+    """
+    Write the original and the adversarial image of an attacked job
+    """
+    (dir_path, filename, target_label, label), img, adversarial_pixels, _ = item
+    adversarial_image = Image.fromarray(adversarial_pixels)
 
     org_dir = os.path.join(IMAGES_OUT, label)
     adv_dir = os.path.join(IMAGES_OUT, label + ADV_SUFFIX)
 
-    if not os.path.exists(org_dir):
-        os.makedirs(org_dir)
+    os.makedirs(org_dir, exist_ok=True)
+    os.makedirs(adv_dir, exist_ok=True)
 
-    if not os.path.exists(adv_dir):
-        os.makedirs(adv_dir)
+    with util.stage('save adversarial'):
+        adversarial_image.save(os.path.join(adv_dir, filename))
+    with util.stage('save original'):
+        img.save(os.path.join(org_dir, filename))
 
-    adversarial_image.save(os.path.join(adv_dir, filename))
-    img.save(os.path.join(org_dir, filename))
-    return
 
+def add_to_shards(writer, item):
+    """
+    Append the original and the adversarial image of an attacked job to a
+    shard store, as pixels or as normalized float16 model inputs
+    """
+    (dir_path, filename, target_label, label), img, adversarial_pixels, adversarial_tensor = item
+    if writer.dtype == 'float16':
+        original, adversarial = util.preprocess(img)[0].numpy(), adversarial_tensor.numpy()
+    else:
+        original, adversarial = np.asarray(img), adversarial_pixels
+    with util.stage('shard write'):
+        writer.add(filename, label, target_class(target_label), original, adversarial)
 
-if __name__ == '__main__':
-    executor = ThreadPoolExecutor(max_workers=4)
 
-    for group in os.listdir(IMAGES_PATH):
-        group_dir = os.path.join(IMAGES_PATH, group)
-        labels = os.listdir(group_dir)
+def generate_adversarial_image(dir_path, filename, target_label, label):
+    save_images(attack_job((dir_path, filename, target_label, label)))
+
+
+def job_key(job):
+    """
+    Manifest key of a job, the path of its outputs relative to IMAGES_OUT
+    """
+    dir_path, filename, target_label, label = job
+    return os.path.join(label, filename)
+
+
+def job_entry(job, bfloat16=False):
+    """
+    Manifest entry describing everything the outputs of a job depend on
+    """
+    dir_path, filename, target_label, label = job
+    image_path = os.path.join(dir_path, filename)
+    # Catalogued hashes are only trusted while the file's mtime and size
+    # still match its catalogue entry
+    source = get_catalog().get(image_path)
+    stat = os.stat(image_path)
+    if source is None or (source['mtime'], source['size']) != (stat.st_mtime, stat.st_size):
+        sha256 = manifest.file_hash(image_path)
+    else:
+        sha256 = source['sha256']
+    entry = {
+        'source': os.path.relpath(image_path, IMAGES_PATH),
+        'sha256': sha256,
+        'model': MODEL_NAME,
+        'target': target_class(target_label),
+        'bfloat16': bfloat16
+    }
+    entry.update(ATTACK_PARAMS)
+    return entry
+
+
+def _outputs_exist(job):
+    dir_path, filename, target_label, label = job
+    return (os.path.exists(os.path.join(IMAGES_OUT, label, filename)) and
+            os.path.exists(os.path.join(IMAGES_OUT, label + ADV_SUFFIX, filename)))
+
+
+def pending_jobs(jobs, generated, entries, force=False, bfloat16=False):
+    """
+    Yield the jobs whose outputs are missing or were generated from a
+    different source content, model or attack parameters
+
+    Parameters:
+    -----------
+    jobs: iterable
+        Candidate jobs
+    generated: Manifest
+        Manifest of the outputs generated so far
+    entries: dict
+        Filled with the manifest entry of every yielded job, to be recorded
+        once its outputs are written
+    force: bool
+        Yield all jobs (default: False)
+    bfloat16: bool
+        Outputs are generated under bfloat16 autocast (default: False)
+    """
+    for job in jobs:
+        key, entry = job_key(job), job_entry(job, bfloat16)
+        if not force and generated.get(key) == entry and _outputs_exist(job):
+            continue
+        entries[key] = entry
+        yield job
 
-        label_dir = [os.path.join(group_dir, labels[0]), os.path.join(group_dir, labels[1])]
 
-        for image in os.listdir(label_dir[0]):
-            executor.submit(generate_adversarial_image, label_dir[0], image, target_label=labels[1], label=labels[0])
+def run(workers=1, batch_size=16, decode_workers=2, encode_workers=2, force=False,
+        bfloat16=False, output='jpeg', shard_dtype='uint8',
+        cache_bytes=0, plan=None, profile=None):
+    """
+    Generate adversarial images for all jobs, either streamed through a
+    decode -> attack -> encode pipeline in the current process or in a pool
+    of worker processes that each run the pipeline on chunks of batch_size
+    jobs
 
-        for image in os.listdir(label_dir[1]):
-            executor.submit(generate_adversarial_image, label_dir[1], image, target_label=labels[0], label=labels[1])
+    Parameters:
+    -----------
+    workers: int
+        Number of worker processes, each with its own model replica and an
+        equal share of the CPU cores (default: 1)
+    batch_size: int
+        Number of images attacked at once by the pipeline (default: 16)
+    decode_workers: int
+        Number of pipeline threads decoding source images (default: 2)
+    encode_workers: int
+        Number of pipeline threads encoding output images (default: 2)
+    force: bool
+        Regenerate all outputs instead of only new or changed ones
+        (default: False)
+    bfloat16: bool
+        Attack under bfloat16 autocast (default: False)
+    output: str
+        'jpeg' to write JPEG files into IMAGES_OUT/<label> and
+        IMAGES_OUT/<label>_adv, 'shards' to write a fresh shard store into
+        SHARDS_PATH (default: 'jpeg')
+    shard_dtype: str
+        'uint8', 'float16' or 'delta' storage of the shard store, delta keeps
+        losslessly compressed originals and adversarial deltas
+        (default: 'uint8')
+    cache_bytes: int
+        Size cap of the on-disk cache of decoded source images in
+        TENSOR_CACHE_PATH, lets reruns with other attack parameters skip
+        decoding (default: 0, no cache)
+    plan: dict
+        Per-image targets as returned by load_plan (default: None, attack
+        every image towards the other label of its group)
+    profile: str
+        Chrome trace file to write per-stage timings to, a per-stage summary
+        is printed as well. Only supported with a single worker process
+        (default: None, no timing)
+    """
+    if profile is not None and workers > 1:
+        raise ValueError('Profiling is only supported with a single worker process')
+    if output == 'shards':
+        # Shard stores are always written from scratch
+        writer = store.ShardWriter(SHARDS_PATH, dtype=shard_dtype)
+        jobs = list_jobs(plan=plan)
+
+        def write(item):
+            add_to_shards(writer, item)
+    else:
+        writer = None
+        generated = manifest.Manifest(MANIFEST_PATH)
+        entries = {}
+        jobs = pending_jobs(list_jobs(plan=plan), generated, entries, force, bfloat16)
+
+        def record(job):
+            dir_path, filename, target_label, label = job
+            key = job_key(job)
+            entry = entries.pop(key)
+            get_catalog().add(os.path.join(IMAGES_OUT, label, filename), label, True, entry)
+            get_catalog().add(os.path.join(IMAGES_OUT, label + ADV_SUFFIX, filename),
+                              label, False, entry)
+            generated.record(key, entry)
+
+        def write(item):
+            save_images(item)
+            record(item[0])
+
+    try:
+        if workers <= 1:
+            init_worker(bfloat16=bfloat16, cache_bytes=cache_bytes)
+            timer = profiler.Profiler() if profile is not None else None
+            profiler.install(timer)
+            try:
+                pipeline.run_pipeline(jobs, load_image, attack_batch, write,
+                                      batch_size=batch_size, decode_workers=decode_workers,
+                                      encode_workers=encode_workers, queue_size=4 * batch_size)
+            finally:
+                profiler.install(None)
+            if timer is not None:
+                timer.stop()
+                timer.export_chrome_trace(profile)
+                timer.print_summary()
+        elif writer is None:
+            # Workers encode the JPEGs themselves, only the manifest is
+            # written here
+            _run_workers(jobs, workers, batch_size, bfloat16, cache_bytes,
+                         functools.partial(attack_jobs, decode_workers=decode_workers,
+                                           encode_workers=encode_workers, save=True),
+                         record)
+        else:
+            _run_workers(jobs, workers, batch_size, bfloat16, cache_bytes,
+                         functools.partial(attack_jobs, decode_workers=decode_workers,
+                                           encode_workers=1),
+                         write)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def attack_jobs(jobs, decode_workers=2, encode_workers=2, save=False):
+    """
+    Stream a chunk of jobs through the pipeline as one batch, returns the
+    attacked items, or only their jobs when the images are saved here
+    """
+    results = []
+
+    def collect(item):
+        if save:
+            save_images(item)
+            item = item[0]
+        # list.append is atomic, encoding threads need no lock
+        results.append(item)
+
+    pipeline.run_pipeline(jobs, load_image, attack_batch, collect, batch_size=len(jobs),
+                          decode_workers=decode_workers, encode_workers=encode_workers,
+                          queue_size=len(jobs))
+    return results
+
+
+def _run_workers(jobs, workers, batch_size, bfloat16, cache_bytes, worker_fn, on_result):
+    """
+    Run worker_fn for every chunk of batch_size jobs in a pool of worker
+    processes and pass each of its results to on_result in the current
+    process
+    """
+
+    if not os.path.exists(weights.cache_path(MODEL_NAME, CACHE_DIR)):
+        # Fill the model cache once here instead of in every worker
+        load_model()
+    num_threads = max(1, (os.cpu_count() or 1) // workers)
+    # Spawned workers start without the parent's torch thread pool state
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=init_worker,
+                             initargs=(num_threads, bfloat16, cache_bytes)) as executor:
+        jobs = iter(jobs)
+        chunks = iter(lambda: list(itertools.islice(jobs, batch_size)), [])
+        futures = [executor.submit(worker_fn, chunk) for chunk in chunks]
+        for future in as_completed(futures):
+            for result in future.result():
+                on_result(result)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate adversarial images')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes, each with its own model')
+    parser.add_argument('--batch-size', type=int, default=16,
+                        help='number of images attacked at once')
+    parser.add_argument('--decode-workers', type=int, default=2,
+                        help='number of image decoding threads per process')
+    parser.add_argument('--encode-workers', type=int, default=2,
+                        help='number of image encoding threads per process')
+    parser.add_argument('--force', action='store_true',
+                        help='regenerate all outputs, not only new or changed ones')
+    parser.add_argument('--bfloat16', action='store_true',
+                        help='attack under bfloat16 autocast')
+    parser.add_argument('--output', choices=['jpeg', 'shards'], default='jpeg',
+                        help='write JPEG files or a memory-mappable shard store')
+    parser.add_argument('--shard-dtype', choices=['uint8', 'float16', 'delta'], default='uint8',
+                        help='storage of the shard store, pixels, normalized model inputs '
+                             'or compressed pixels and adversarial deltas')
+    parser.add_argument('--cache-mb', type=int, default=0,
+                        help='size cap of the on-disk cache of decoded source images, '
+                             'lets attack parameter sweeps skip decoding (default: disabled)')
+    parser.add_argument('--plan', nargs='?', const=PLAN_PATH, default=None,
+                        help='attack towards the per-image targets chosen by generator.planner')
+    parser.add_argument('--profile', metavar='TRACE',
+                        help='time every stage, write a Chrome trace to TRACE and print '
+                             'a per-stage summary (single worker process only)')
+    args = parser.parse_args()
 
+    run(workers=args.workers, batch_size=args.batch_size,
+        decode_workers=args.decode_workers, encode_workers=args.encode_workers,
+        force=args.force, bfloat16=args.bfloat16, output=args.output,
+        shard_dtype=args.shard_dtype, cache_bytes=args.cache_mb << 20,
+        plan=load_plan(args.plan) if args.plan is not None else None, profile=args.profile)
@@ -0,0 +1,58 @@
+import hashlib
+import json
+import os
+import threading
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """
+    Return the SHA-256 hex digest of the file content
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """
+    Append-only record of generated outputs, one JSON line per output
+
+    Each line maps an output key to the entry it was generated from (source
+    content hash, model, attack parameters). Later lines override earlier
+    ones, so a run that is killed keeps everything recorded up to that
+    point and a rerun only has to process missing or changed entries.
+
+    Parameters:
+    -----------
+    path: str
+        Manifest file, created on first record
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Partially written line of an interrupted run
+                        continue
+                    self._entries[record['key']] = record['entry']
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    def record(self, key, entry):
+        """
+        Record that the output key was generated from entry
+        """
+        line = json.dumps({'key': key, 'entry': entry}, sort_keys=True)
+        with self._lock:
+            self._entries[key] = entry
+            with open(self._path, 'a') as f:
+                f.write(line + '\n')
@@ -0,0 +1,130 @@
+import queue
+import threading
+
+# Marks the end of the stream on a stage queue
+_DONE = object()
+
+
+class _Stopped(Exception):
+    """
+    Raised inside a stage when another stage failed and the pipeline is
+    shutting down
+    """
+
+
+def _put(q, item, stop):
+    while True:
+        if stop.is_set():
+            raise _Stopped()
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+
+def _get(q, stop):
+    while True:
+        if stop.is_set():
+            raise _Stopped()
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+
+
+def run_pipeline(jobs, decode, attack, encode, batch_size=16, decode_workers=2,
+                 encode_workers=2, queue_size=64):
+    """
+    Stream jobs through decode -> attack -> encode stages connected by
+    bounded queues
+
+    Decoding and encoding run in thread pools so that Pillow work, which
+    releases the GIL, overlaps with the attack running in the calling
+    thread. Bounded queues apply backpressure, so at most a few batches are
+    held in memory however many jobs there are.
+
+    Parameters:
+    -----------
+    jobs: iterable
+        Jobs to process, consumed lazily
+    decode: callable
+        Turns a job into an item for the attack stage
+    attack: callable
+        Turns a list of up to batch_size decoded items into a list of items
+        for the encode stage
+    encode: callable
+        Consumes one attacked item
+    batch_size: int
+        Number of items handed to attack at once (default: 16)
+    decode_workers: int
+        Number of decoding threads (default: 2)
+    encode_workers: int
+        Number of encoding threads (default: 2)
+    queue_size: int
+        Capacity of each queue between stages (default: 64)
+    """
+    job_queue = queue.Queue(queue_size)
+    decoded_queue = queue.Queue(queue_size)
+    attacked_queue = queue.Queue(queue_size)
+    stop = threading.Event()
+    errors = []
+
+    def guarded(fn):
+        # Record the first failure and make every other stage wind down
+        def run():
+            try:
+                fn()
+            except _Stopped:
+                pass
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+        return run
+
+    def feed():
+        for job in jobs:
+            _put(job_queue, job, stop)
+        for _ in range(decode_workers):
+            _put(job_queue, _DONE, stop)
+
+    def decode_loop():
+        while True:
+            job = _get(job_queue, stop)
+            if job is _DONE:
+                _put(decoded_queue, _DONE, stop)
+                return
+            _put(decoded_queue, decode(job), stop)
+
+    def attack_loop():
+        running = decode_workers
+        while running > 0:
+            batch = []
+            while running > 0 and len(batch) < batch_size:
+                item = _get(decoded_queue, stop)
+                if item is _DONE:
+                    running -= 1
+                else:
+                    batch.append(item)
+            if batch:
+                for item in attack(batch):
+                    _put(attacked_queue, item, stop)
+        for _ in range(encode_workers):
+            _put(attacked_queue, _DONE, stop)
+
+    def encode_loop():
+        while True:
+            item = _get(attacked_queue, stop)
+            if item is _DONE:
+                return
+            encode(item)
+
+    stages = [feed] + [decode_loop] * decode_workers + [encode_loop] * encode_workers
+    threads = [threading.Thread(target=guarded(fn), daemon=True) for fn in stages]
+    for thread in threads:
+        thread.start()
+    guarded(attack_loop)()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
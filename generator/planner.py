@@ -0,0 +1,129 @@
+import argparse
+import json
+import os
+
+import torch
+
+from generator import evaluate
+from generator import fgs
+from generator import imagenet_labels
+from generator.main import IMAGES_PATH, PLAN_PATH, list_jobs, load_model, netImageLabels
+
+
+def candidate_classes(keywords):
+    """
+    Return the sorted ImageNet class indices of a target group, every
+    keyword is either an exact label synonym such as 'hot dog' or words
+    that the labels must contain such as 'terrier'
+    """
+    classes = set()
+    for keyword in keywords:
+        index = imagenet_labels.index(keyword)
+        classes.update([index] if index is not None else imagenet_labels.search(keyword))
+    return sorted(classes)
+
+
+def margin_table(session, paths, candidates, batch_size=64, decode_workers=4):
+    """
+    Classify every image once and return the N x C table of logit gaps
+    between its top class and each candidate class
+
+    A gap of 0 means the image is already classified as the candidate, the
+    larger the gap the more FGS iterations a targeted attack needs to close
+    it.
+
+    Parameters:
+    -----------
+    session: AttackSession
+        Session of the attacked model
+    paths: list of str
+        Image files
+    candidates: list of int
+        ImageNet class indices of the target group
+    batch_size: int
+        Number of images classified at once (default: 64)
+    decode_workers: int
+        Number of image decoding threads (default: 4)
+    """
+    candidates = torch.tensor(candidates)
+
+    def gaps(batch):
+        logits = session.logits(batch)
+        return logits.max(1, keepdim=True)[0] - logits[:, candidates]
+
+    return torch.stack([row for _, row in evaluate.map_batches(gaps, paths, batch_size,
+                                                               decode_workers)])
+
+
+def cheapest_targets(table, candidates, exclude=None):
+    """
+    Return, for every image, the candidate class with the smallest logit gap,
+    None for images whose only candidate is excluded
+
+    Parameters:
+    -----------
+    table: torch.Tensor
+        N x C logit gaps as returned by margin_table
+    candidates: list of int
+        ImageNet class indices of the table columns
+    exclude: list of int
+        Class per image that must not be chosen, e.g. its true class
+        (default: None)
+    """
+    candidates = torch.tensor(candidates)
+    if exclude is not None:
+        excluded = candidates.unsqueeze(0) == torch.tensor(exclude).unsqueeze(1)
+        table = table.masked_fill(excluded, float('inf'))
+    gaps, index = table.min(1)
+    return [target if gap != float('inf') else None
+            for target, gap in zip(candidates[index].tolist(), gaps.tolist())]
+
+
+def plan_targets(session, keywords, images_path=IMAGES_PATH, batch_size=64, decode_workers=4):
+    """
+    Choose the cheapest target of a target group for every source image,
+    returns the plan as a dict mapping source paths relative to images_path
+    to class indices, as read by main.load_plan
+
+    Images whose own class is the only candidate are left out of the plan
+    and keep their default target.
+    """
+    candidates = candidate_classes(keywords)
+    if not candidates:
+        raise ValueError('No ImageNet class matches {}'.format(', '.join(keywords)))
+    jobs = list(list_jobs(images_path))
+    paths = [os.path.join(dir_path, filename) for dir_path, filename, _, _ in jobs]
+    table = margin_table(session, paths, candidates, batch_size, decode_workers)
+    exclude = [netImageLabels.get(label, -1) for _, _, _, label in jobs]
+    targets = cheapest_targets(table, candidates, exclude)
+    return {os.path.relpath(path, images_path): target
+            for path, target in zip(paths, targets) if target is not None}
+
+
+def save_plan(plan, path=PLAN_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(plan, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Choose the cheapest target class of a '
+                                                 'target group for every source image')
+    parser.add_argument('keywords', nargs='+',
+                        help='label synonyms or words defining the target group')
+    parser.add_argument('--output', default=PLAN_PATH,
+                        help='plan file read by generator.main --plan')
+    parser.add_argument('--batch-size', type=int, default=64,
+                        help='number of images classified at once')
+    parser.add_argument('--decode-workers', type=int, default=4,
+                        help='number of image decoding threads')
+    args = parser.parse_args()
+
+    session = fgs.AttackSession(load_model(), use_cuda=False)
+    plan = plan_targets(session, args.keywords, batch_size=args.batch_size,
+                        decode_workers=args.decode_workers)
+    for source, target in sorted(plan.items()):
+        print('{:<40} -> {} {}'.format(source, target, imagenet_labels.label(target)))
+    save_plan(plan, args.output)
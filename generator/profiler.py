@@ -0,0 +1,105 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from generator import util
+
+
+class Profiler:
+    """
+    Collects wall-clock stage timings and counters of one run
+
+    Every timed stage becomes one complete event of the thread it ran on,
+    exportable as a Chrome trace (chrome://tracing, ui.perfetto.dev) and
+    summarized per stage. Timings of CUDA work are only meaningful with
+    CUDA_LAUNCH_BLOCKING=1.
+
+    Modules that must stay importable on their own (fgs, util) do not import
+    this one, their stages go through util.stage, which the profiler is
+    installed into and which is a no-op while none is.
+    """
+
+    def __init__(self):
+        self._events = []
+        self._threads = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._start = time.perf_counter_ns()
+        self._stop = None
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            end = time.perf_counter_ns()
+            thread = threading.current_thread()
+            # list.append is atomic, stages of concurrent threads need no lock
+            self._events.append((name, start, end, thread.ident))
+            self._threads.setdefault(thread.ident, thread.name)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def stop(self):
+        """
+        Mark the end of the run, images/s are reported up to this point
+        """
+        self._stop = time.perf_counter_ns()
+
+    def summary(self):
+        """
+        Return a dict mapping every stage to its call count, total seconds
+        and p50/p95 milliseconds
+        """
+        durations = {}
+        for name, start, end, _ in self._events:
+            durations.setdefault(name, []).append((end - start) / 1e6)
+        result = {}
+        for name, times in durations.items():
+            times.sort()
+            result[name] = {
+                'count': len(times),
+                'total': sum(times) / 1e3,
+                'p50': times[len(times) // 2],
+                'p95': times[min(len(times) - 1, int(0.95 * len(times)))]
+            }
+        return result
+
+    def print_summary(self):
+        wall = ((self._stop or time.perf_counter_ns()) - self._start) / 1e9
+        print('{:<20} {:>8} {:>10} {:>10} {:>10}'.format('stage', 'calls', 'total s',
+                                                        'p50 ms', 'p95 ms'))
+        for name, stats in sorted(self.summary().items(), key=lambda item: -item[1]['total']):
+            print('{:<20} {:>8} {:>10.3f} {:>10.2f} {:>10.2f}'.format(
+                name, stats['count'], stats['total'], stats['p50'], stats['p95']))
+        images = self.counters.get('images', 0)
+        print('{} images in {:.2f} s, {:.2f} images/s'.format(images, wall,
+                                                              images / wall if wall else 0.0))
+
+    def export_chrome_trace(self, path):
+        """
+        Write all events as a Chrome trace JSON file
+        """
+        pid = os.getpid()
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                   'args': {'name': name}} for tid, name in self._threads.items()]
+        events.extend({'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                       'ts': (start - self._start) / 1e3, 'dur': (end - start) / 1e3}
+                      for name, start, end, tid in self._events)
+        end = ((self._stop or time.perf_counter_ns()) - self._start) / 1e3
+        events.extend({'name': name, 'ph': 'C', 'pid': pid, 'ts': end, 'args': {name: value}}
+                      for name, value in self.counters.items())
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def install(profiler):
+    """
+    Route all util.stage timings to profiler, None switches them back off
+    """
+    util.timer = profiler
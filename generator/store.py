@@ -0,0 +1,250 @@
+import io
+import json
+import os
+import threading
+
+import numpy as np
+from PIL import Image
+
+INDEX_FILE = 'index.json'
+
+# Per-image array shape and memory layout of each supported shard dtype,
+# uint8 keeps encoder-ready pixels, float16 keeps normalized model inputs
+# and delta keeps losslessly compressed originals and adversarial deltas
+_LAYOUTS = {
+    'uint8': 'HWC',
+    'float16': 'CHW',
+    'delta': 'HWC',
+}
+
+
+def _image_shape(layout, width, height):
+    return (height, width, 3) if layout == 'HWC' else (3, height, width)
+
+
+def _encode(pixels):
+    # method 2 is within 3% of WebP's smallest output at a tenth of the time
+    f = io.BytesIO()
+    Image.fromarray(pixels).save(f, 'WEBP', lossless=True, quality=100, method=2)
+    return f.getvalue()
+
+
+def _decode(data, offsets, start, stop):
+    """
+    Decode the images start to stop of a .bin file into a uint8 array
+    """
+    return np.stack([np.asarray(Image.open(io.BytesIO(data[offsets[i]:offsets[i + 1]])))
+                     for i in range(start, stop)])
+
+
+class ShardWriter:
+    """
+    Writes originals and adversarials into fixed-layout shard files
+
+    Every shard holds up to shard_size images as two .npy arrays, one of
+    originals and one of adversarials, and index.json maps every image to
+    its shard and offset together with its filename, label and target. The
+    index is rewritten whenever a shard is completed.
+
+    With the delta dtype both arrays are replaced by lossless WebP images
+    appended to a .bin file per shard, the offsets of every image are kept
+    in the index. Originals are stored as they are, adversarials as their
+    difference to the original offset by 128. FGS perturbations are
+    bounded by alpha * iterations, so the deltas are small and compress
+    well.
+
+    Parameters:
+    -----------
+    path: str
+        Directory of the shard store, existing shards are overwritten
+    dtype: str
+        'uint8' for HWC pixels, 'float16' for normalized CHW model inputs or
+        'delta' for compressed HWC pixels and adversarial deltas
+        (default: 'uint8')
+    shard_size: int
+        Maximum number of images per shard (default: 1024)
+    width: int
+        Image width (default: 224)
+    height: int
+        Image height (default: 224)
+    """
+
+    def __init__(self, path, dtype='uint8', shard_size=1024, width=224, height=224):
+        if dtype not in _LAYOUTS:
+            raise ValueError('Unsupported shard dtype: {}'.format(dtype))
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.dtype = dtype
+        self._layout = _LAYOUTS[dtype]
+        self._shape = _image_shape(self._layout, width, height)
+        self._shard_size = shard_size
+        self._lock = threading.Lock()
+        self._shards = []
+        self._records = []
+        self._arrays = None
+        self._count = 0
+
+    def _shard_files(self, index):
+        if self.dtype == 'delta':
+            return ('shard-{:05d}-original.bin'.format(index),
+                    'shard-{:05d}-delta.bin'.format(index))
+        return ('shard-{:05d}-original.npy'.format(index),
+                'shard-{:05d}-adversarial.npy'.format(index))
+
+    def _open_shard(self):
+        original, adversarial = self._shard_files(len(self._shards))
+        shape = (self._shard_size,) + self._shape
+        if self.dtype == 'delta':
+            # Encoded images are appended as they arrive, offsets[i] is the
+            # end of image i - 1 in the file
+            self._arrays = [open(os.path.join(self.path, name), 'wb')
+                            for name in (original, adversarial)]
+            self._offsets = [[0], [0]]
+        else:
+            self._arrays = [np.lib.format.open_memmap(os.path.join(self.path, name), mode='w+',
+                                                      dtype=self.dtype, shape=shape)
+                            for name in (original, adversarial)]
+        self._count = 0
+
+    def _finish_shard(self):
+        names = self._shard_files(len(self._shards))
+        shard = {'original': names[0], 'adversarial': names[1], 'count': self._count}
+        if self.dtype == 'delta':
+            for f in self._arrays:
+                f.close()
+            shard['original_offsets'], shard['adversarial_offsets'] = self._offsets
+        else:
+            for name, array in zip(names, self._arrays):
+                if self._count < self._shard_size:
+                    # Shrink the last shard to the images it actually holds
+                    tmp_path = os.path.join(self.path, name + '.tmp')
+                    with open(tmp_path, 'wb') as f:
+                        np.save(f, array[:self._count])
+                    os.replace(tmp_path, os.path.join(self.path, name))
+                else:
+                    array.flush()
+        self._shards.append(shard)
+        self._arrays = None
+        self._write_index()
+
+    def _write_index(self):
+        index = {
+            'dtype': self.dtype,
+            'layout': self._layout,
+            'shape': list(self._shape),
+            'shards': self._shards,
+            'records': self._records
+        }
+        tmp_path = os.path.join(self.path, INDEX_FILE + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, os.path.join(self.path, INDEX_FILE))
+
+    def add(self, filename, label, target, original, adversarial):
+        """
+        Append one original/adversarial pair, arrays must match the shard
+        dtype layout
+        """
+        if self.dtype == 'delta':
+            # Encoded before taking the lock so that encoding threads
+            # compress concurrently
+            delta = adversarial.astype(np.int16) - original
+            if delta.min() < -128 or delta.max() > 127:
+                raise ValueError('Adversarial delta of {} does not fit into int8'.format(filename))
+            blobs = (_encode(original), _encode((delta + 128).astype(np.uint8)))
+        with self._lock:
+            if self._arrays is None:
+                self._open_shard()
+            if self.dtype == 'delta':
+                for f, offsets, blob in zip(self._arrays, self._offsets, blobs):
+                    f.write(blob)
+                    offsets.append(offsets[-1] + len(blob))
+            else:
+                self._arrays[0][self._count] = original
+                self._arrays[1][self._count] = adversarial
+            self._records.append({'filename': filename, 'label': label, 'target': target,
+                                  'shard': len(self._shards), 'offset': self._count})
+            self._count += 1
+            if self._count == self._shard_size:
+                self._finish_shard()
+
+    def close(self):
+        """
+        Complete the last shard and write the final index
+        """
+        with self._lock:
+            if self._arrays is not None:
+                self._finish_shard()
+            else:
+                self._write_index()
+
+
+class ShardReader:
+    """
+    Memory-maps a shard store written by ShardWriter
+
+    Parameters:
+    -----------
+    path: str
+        Directory of the shard store
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            index = json.load(f)
+        self.dtype = index['dtype']
+        self.layout = index['layout']
+        self.records = index['records']
+        self._shards = index['shards']
+        self._arrays = {}
+
+    def __len__(self):
+        return len(self.records)
+
+    def _decode_deltas(self, shard, start, stop):
+        originals = _decode(np.memmap(os.path.join(self.path, shard['original']), mode='r'),
+                            shard['original_offsets'], start, stop)
+        deltas = _decode(np.memmap(os.path.join(self.path, shard['adversarial']), mode='r'),
+                         shard['adversarial_offsets'], start, stop)
+        return originals, (deltas.astype(np.int16) - 128).astype(np.int8)
+
+    def shard(self, index):
+        """
+        Return the memory-mapped (originals, adversarials) arrays of a shard,
+        for delta stores the decoded originals and int8 deltas
+        """
+        if index not in self._arrays:
+            shard = self._shards[index]
+            if self.dtype == 'delta':
+                # Only the shard being read is kept decoded
+                self._arrays.clear()
+                self._arrays[index] = self._decode_deltas(shard, 0, shard['count'])
+            else:
+                self._arrays[index] = tuple(
+                    np.load(os.path.join(self.path, shard[name]), mmap_mode='r')
+                    for name in ('original', 'adversarial'))
+        return self._arrays[index]
+
+    def batches(self, batch_size):
+        """
+        Yield (records, originals, adversarials) batches of at most
+        batch_size images. The arrays are zero-copy views into the shards,
+        except for delta stores where every batch is decoded on its own
+        """
+        start = 0
+        for index, shard in enumerate(self._shards):
+            if self.dtype != 'delta':
+                originals, adversarials = self.shard(index)
+            for offset in range(0, shard['count'], batch_size):
+                stop = min(offset + batch_size, shard['count'])
+                if self.dtype == 'delta':
+                    batch_originals, deltas = self._decode_deltas(shard, offset, stop)
+                    # Adding the two's complement bytes wraps around exactly
+                    # to original + delta, which always lies in [0, 255]
+                    yield (self.records[start + offset:start + stop], batch_originals,
+                           np.add(batch_originals, deltas.view(np.uint8)))
+                else:
+                    yield (self.records[start + offset:start + stop],
+                           originals[offset:stop], adversarials[offset:stop])
+            start += shard['count']
@@ -0,0 +1,91 @@
+import hashlib
+import os
+import threading
+import time
+
+import numpy as np
+
+
+class TensorCache:
+    """
+    On-disk LRU cache of decoded and resized source images
+
+    Entries are uint8 H x W x 3 arrays stored as .npy files and returned
+    memory-mapped, keyed by the source path, mtime and size together with
+    the preprocessing parameters, so a changed source or a different
+    resolution never hits a stale entry. Entry mtimes track the last use;
+    once the cache grows past max_bytes the least recently used entries are
+    evicted.
+
+    Parameters:
+    -----------
+    path: str
+        Cache directory
+    max_bytes: int
+        Size cap of the cache (default: 2 GiB)
+    """
+
+    def __init__(self, path, max_bytes=2 << 30):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._size = sum(entry.stat().st_size for entry in os.scandir(path)
+                         if entry.name.endswith('.npy'))
+
+    def _entry_path(self, source, params):
+        stat = os.stat(source)
+        key = '{}|{}|{}|{}'.format(os.path.abspath(source), stat.st_mtime_ns, stat.st_size, params)
+        return os.path.join(self.path, hashlib.sha1(key.encode()).hexdigest() + '.npy')
+
+    def get(self, source, params):
+        """
+        Return the cached array of source preprocessed with params, None on
+        a miss
+
+        Parameters:
+        -----------
+        source: str
+            Source image file
+        params: tuple
+            Preprocessing parameters the entry depends on
+        """
+        entry_path = self._entry_path(source, params)
+        try:
+            array = np.load(entry_path, mmap_mode='r')
+        except (FileNotFoundError, ValueError):
+            return None
+        now = time.time()
+        os.utime(entry_path, (now, now))
+        return array
+
+    def put(self, source, params, array):
+        """
+        Store the preprocessed array of source, evicting least recently used
+        entries if the cache grows past its size cap
+        """
+        entry_path = self._entry_path(source, params)
+        tmp_path = '{}.{}.{}.tmp'.format(entry_path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, array)
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, entry_path)
+        with self._lock:
+            self._size += size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        entries = sorted((entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                         for entry in os.scandir(self.path) if entry.name.endswith('.npy'))
+        self._size = sum(size for _, size, _ in entries)
+        # Evict down to 90% of the cap so that eviction is not triggered by
+        # every following put
+        for _, size, path in entries:
+            if self._size <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._size -= size
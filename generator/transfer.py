@@ -0,0 +1,173 @@
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from generator import fgs
+from generator import manifest
+from generator import store
+from generator import util
+from generator import weights
+from generator.main import (ADV_SUFFIX, CACHE_DIR, IMAGES_OUT, MANIFEST_PATH, SHARDS_PATH,
+                            netImageLabels)
+
+# Classifiers the adversarials are evaluated against by default, the first
+# one is the attacked model
+MODELS = ('resnet34', 'resnet50', 'vgg16', 'densenet121', 'mobilenet_v2')
+
+
+def _decode(path):
+    return np.array(util.load_image(path))
+
+
+def load_pairs(path=IMAGES_OUT, manifest_path=MANIFEST_PATH, decode_workers=4):
+    """
+    Decode every original/adversarial pair written by the generator as JPEG
+    files, returns the (filename, label, target) record of every pair and
+    the N x H x W x 3 uint8 arrays of originals and adversarials
+
+    Targets are taken from the generator manifest, pairs without a manifest
+    entry are skipped.
+
+    Parameters:
+    -----------
+    path: str
+        Directory with one <label> and one <label>_adv subdirectory per class
+        (default: generator/images_out)
+    manifest_path: str
+        Manifest of the generated outputs (default: images_out/manifest.jsonl)
+    decode_workers: int
+        Number of image decoding threads (default: 4)
+    """
+    generated = manifest.Manifest(manifest_path)
+    records, files = [], []
+    for label in sorted(os.listdir(path)):
+        adv_dir = os.path.join(path, label + ADV_SUFFIX)
+        if label.endswith(ADV_SUFFIX) or not os.path.isdir(adv_dir):
+            continue
+        for filename in sorted(os.listdir(os.path.join(path, label))):
+            entry = generated.get(os.path.join(label, filename))
+            if entry is None or not os.path.exists(os.path.join(adv_dir, filename)):
+                continue
+            records.append({'filename': filename, 'label': label, 'target': entry['target']})
+            files.append((os.path.join(path, label, filename), os.path.join(adv_dir, filename)))
+    if not files:
+        raise ValueError('No generated pairs with a manifest entry in {}'.format(path))
+
+    with ThreadPoolExecutor(decode_workers) as executor:
+        originals = np.stack(list(executor.map(_decode, [f for f, _ in files])))
+        adversarials = np.stack(list(executor.map(_decode, [f for _, f in files])))
+    return records, originals, adversarials
+
+
+def load_shard_pairs(path=SHARDS_PATH):
+    """
+    Read every original/adversarial pair of a uint8 or delta shard store,
+    returns the same (records, originals, adversarials) as load_pairs
+    """
+    reader = store.ShardReader(path)
+    if reader.layout != 'HWC':
+        raise ValueError('Shard store of dtype {} does not hold pixels'.format(reader.dtype))
+    originals, adversarials = [], []
+    for _, original, adversarial in reader.batches(1024):
+        originals.append(np.array(original))
+        adversarials.append(np.array(adversarial))
+    return reader.records, np.concatenate(originals), np.concatenate(adversarials)
+
+
+def evaluate(model_names, originals, adversarials, batch_size=64,
+             one_at_a_time=False):
+    """
+    Classify originals and adversarials with every model of a zoo, returns
+    a dict mapping each model name to its (original, adversarial) top-1
+    predictions
+
+    Every batch is normalized once and shared by all resident models. With
+    one_at_a_time only one model is loaded at any time, which bounds memory
+    by the largest model while the decoded images stay resident.
+
+    Parameters:
+    -----------
+    model_names: list of str
+        Names of torchvision model constructors, weights are taken from the
+        generator's weight cache
+    originals: numpy array
+        N x H x W x 3 uint8 originals
+    adversarials: numpy array
+        N x H x W x 3 uint8 adversarials
+    batch_size: int
+        Number of images classified at once (default: 64)
+    one_at_a_time: bool
+        Load and evaluate the models one after the other (default: False)
+    """
+    height, width = originals.shape[1:3]
+    buffer = util.BatchBuffer(width, height)
+
+    def run(sessions):
+        preds = {name: ([], []) for name in sessions}
+        for start in range(0, len(originals), batch_size):
+            for i, pixels in enumerate((originals, adversarials)):
+                batch = buffer.fill(list(pixels[start:start + batch_size]))
+                for name, session in sessions.items():
+                    preds[name][i].append(session.classify(batch)[0])
+        return {name: (torch.cat(original), torch.cat(adversarial))
+                for name, (original, adversarial) in preds.items()}
+
+    def load(name):
+        return fgs.AttackSession(weights.load_pretrained(name, CACHE_DIR), use_cuda=False)
+
+    if not one_at_a_time:
+        return run({name: load(name) for name in model_names})
+    results = {}
+    for name in model_names:
+        # The previous session is released before the next model is loaded
+        results.update(run({name: load(name)}))
+    return results
+
+
+def success_matrix(results, records):
+    """
+    Return a dict mapping each model name to its clean accuracy, the rate of
+    adversarials it misclassifies and the rate it classifies as the target
+    """
+    labels = torch.tensor([netImageLabels[record['label']] for record in records])
+    targets = torch.tensor([record['target'] for record in records])
+    return {name: {'clean': (original == labels).float().mean().item(),
+                   'fooled': (adversarial != labels).float().mean().item(),
+                   'target': (adversarial == targets).float().mean().item()}
+            for name, (original, adversarial) in results.items()}
+
+
+def print_matrix(matrix, images):
+    print('Transferability over {} pairs'.format(images))
+    print('  {:<16} {:>8} {:>8} {:>8}'.format('model', 'clean', 'fooled', 'target'))
+    for name, rates in matrix.items():
+        print('  {:<16} {:8.3f} {:8.3f} {:8.3f}'.format(name, rates['clean'], rates['fooled'],
+                                                         rates['target']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Evaluate generated adversarials against '
+                                                 'a zoo of classifiers')
+    parser.add_argument('--models', nargs='+', default=list(MODELS),
+                        help='torchvision model constructors to evaluate')
+    parser.add_argument('--shards', nargs='?', const=SHARDS_PATH, default=None,
+                        help='read the pairs from a uint8 or delta shard store '
+                             'instead of images_out')
+    parser.add_argument('--batch-size', type=int, default=64,
+                        help='number of images classified at once')
+    parser.add_argument('--decode-workers', type=int, default=4,
+                        help='number of image decoding threads')
+    parser.add_argument('--one-at-a-time', action='store_true',
+                        help='keep only one model in memory at a time')
+    args = parser.parse_args()
+
+    if args.shards is not None:
+        records, originals, adversarials = load_shard_pairs(args.shards)
+    else:
+        records, originals, adversarials = load_pairs(decode_workers=args.decode_workers)
+    results = evaluate(args.models, originals, adversarials, args.batch_size,
+                       args.one_at_a_time)
+    print_matrix(success_matrix(results, records), len(records))
@@ -1,5 +1,111 @@
+import contextlib
+
+import numpy as np
 import torch
-from torchvision import transforms
+from PIL import Image
+
+# Stage timer installed by generator.profiler, stages cost nothing while it
+# is None
+timer = None
+_NO_TIMER = contextlib.nullcontext()
+
+
+def stage(name):
+    """
+    Context manager timing a stage with the installed timer, a no-op
+    without one
+    """
+    return _NO_TIMER if timer is None else timer.stage(name)
+
+
+def load_image(path, width=224, height=224):
+    """
+    Decode an image resized to width x height with a single resize
+
+    JPEGs are decoded in draft mode at the smallest DCT scale that is still
+    at least the requested size, so large photos are never fully decoded.
+
+    Parameters:
+    -----------
+    path: str
+        Image file
+    width: int
+        Required width (default: 224)
+    height: int
+        Required height (default: 224)
+    """
+    with stage('decode'):
+        im = Image.open(path)
+        im.draft('RGB', (width, height))
+        im = im.convert('RGB')
+    if im.size != (width, height):
+        with stage('resize'):
+            im = im.resize((width, height), Image.LANCZOS)
+    return im
+
+
+def preprocess_into(im, out, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
+    """
+    Normalize an RGB image straight into a preallocated 3D PyTorch tensor
+
+    Parameters:
+    -----------
+    im: PIL image
+        Input image, already of the size of out
+    out: 3D PyTorch Tensor
+        Float tensor of shape 3 x height x width to write into
+    mean: float or tuple of floats
+        Mean of the pixels
+        (default: [0.485, 0.456, 0.406] from ImageNet)
+    std: float or tuple of floats
+        Standard deviation of the pixels
+        (default: [0.229, 0.224, 0.225] from ImageNet)
+    """
+    std = torch.tensor(std, dtype=torch.float32).view(-1, 1, 1)
+    mean = torch.tensor(mean, dtype=torch.float32).view(-1, 1, 1)
+    # (x / 255 - mean) / std as one multiply of the uint8 pixels and one shift
+    pixels = torch.from_numpy(np.array(im)).permute(2, 0, 1)
+    torch.mul(pixels, 1.0 / (255.0 * std), out=out)
+    return out.sub_(mean / std)
+
+
+class BatchBuffer:
+    """
+    Reusable batch tensor that images are normalized into slot by slot
+
+    Parameters:
+    -----------
+    width: int
+        Image width (default: 224)
+    height: int
+        Image height (default: 224)
+    mean: float or tuple of floats
+        Mean of the pixels
+        (default: [0.485, 0.456, 0.406] from ImageNet)
+    std: float or tuple of floats
+        Standard deviation of the pixels
+        (default: [0.229, 0.224, 0.225] from ImageNet)
+    """
+
+    def __init__(self, width=224, height=224, mean=(0.485, 0.456, 0.406),
+                 std=(0.229, 0.224, 0.225)):
+        self._shape = (3, height, width)
+        self._mean = mean
+        self._std = std
+        self._buffer = torch.empty((0,) + self._shape)
+
+    def fill(self, images):
+        """
+        Normalize a list of images into the buffer and return the batch view,
+        which is overwritten by the next call
+        """
+        if len(images) > self._buffer.size(0):
+            self._buffer = torch.empty((len(images),) + self._shape)
+        batch = self._buffer[:len(images)]
+        with stage('preprocess'):
+            for slot, im in zip(batch, images):
+                preprocess_into(im, slot, self._mean, self._std)
+        return batch
 
 
 def preprocess(im, width=224, height=224, mean=(0.485, 0.456, 0.406),
@@ -23,11 +129,36 @@ def preprocess(im, width=224, height=224, mean=(0.485, 0.456, 0.406),
         Standard deviation of the pixels
         (default: [0.229, 0.224, 0.225] from ImageNet)
     """
-    tforms = transforms.Compose([transforms.Resize((width, height)),
-                                 transforms.ToTensor(),
-                                 transforms.Normalize(mean, std),
-                                 transforms.Lambda(lambda x : torch.unsqueeze(x, 0))])
-    return tforms(im)
+    im = im.convert('RGB')
+    if im.size != (width, height):
+        im = im.resize((width, height), Image.BILINEAR)
+    return preprocess_into(im, torch.empty(1, 3, height, width)[0], mean, std).unsqueeze(0)
+
+
+def postprocess_batch(batch, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
+    """
+    Convert a batch of normalized images into uint8 RGB arrays in one pass
+
+    Parameters:
+    -----------
+    batch: 4D PyTorch Tensor
+        Normalized images of shape N x 3 x height x width
+    mean: float or tuple of floats
+        Mean of the pixels that was used for preprocessing
+        (default: [0.485, 0.456, 0.406] from ImageNet)
+    std: float or tuple of floats
+        Standard deviation of the pixels that was used for preprocessing
+        (default: [0.229, 0.224, 0.225] from ImageNet)
+
+    Returns a numpy array of shape N x height x width x 3 ready for encoding
+    """
+    std = torch.tensor(std, dtype=batch.dtype).view(1, -1, 1, 1)
+    mean = torch.tensor(mean, dtype=batch.dtype).view(1, -1, 1, 1)
+    with stage('postprocess'):
+        # (x * std + mean) * 255 rounded to the nearest pixel value
+        pixels = torch.addcmul(255.0 * mean, batch.detach().cpu(), 255.0 * std)
+        pixels = pixels.round_().clamp_(0, 255).to(torch.uint8)
+        return pixels.permute(0, 2, 3, 1).contiguous().numpy()
 
 
 def postprocess(im, mean=[-0.485, -0.456, -0.406],
@@ -46,8 +177,5 @@ def postprocess(im, mean=[-0.485, -0.456, -0.406],
         Inverse of standard deviation of the pixels that was used for preprocessing
         (default: [1/0.229, 1/0.224, 1/0.225] from ImageNet)
     """
-    tforms = transforms.Compose([transforms.Lambda(lambda x : torch.squeeze(x, 0)),
-                                 transforms.Normalize([0.0, 0.0, 0.0], std),
-                                 transforms.Normalize(mean, [1.0, 1.0, 1.0]),
-                                 transforms.ToPILImage()])
-    return tforms(im)
+    pixels = postprocess_batch(im, [-m for m in mean], [1.0 / s for s in std])
+    return Image.fromarray(pixels[0])
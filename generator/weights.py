@@ -0,0 +1,47 @@
+import os
+
+import torch
+from torchvision import models
+
+
+def cache_path(name, cache_dir):
+    """
+    Return the path of the cached state dict of a model
+    """
+    return os.path.join(cache_dir, name + '.pt')
+
+
+def load_pretrained(name, cache_dir):
+    """
+    Build a torchvision model with pretrained weights from a local
+    state-dict cache
+
+    The cached state dict is memory-mapped and assigned to a model built
+    on the meta device, so neither random initialization nor a weight copy
+    is paid and loading takes milliseconds. On a cache miss the weights are
+    taken from torchvision once (its own download cache works offline) and
+    written to the cache.
+
+    Parameters:
+    -----------
+    name: str
+        Name of the torchvision model constructor, e.g. 'resnet34'
+    cache_dir: str
+        Directory of the cached state dicts
+    """
+    path = cache_path(name, cache_dir)
+    if not os.path.exists(path):
+        model = getattr(models, name)(weights='DEFAULT')
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a temporary file first so concurrent readers never see a
+        # partially written cache
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        torch.save(model.state_dict(), tmp_path)
+        os.replace(tmp_path, path)
+        return model
+
+    state_dict = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    with torch.device('meta'):
+        model = getattr(models, name)()
+    model.load_state_dict(state_dict, assign=True)
+    return model
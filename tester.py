@@ -2,11 +2,13 @@ from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QDesktopWidget,
 from PyQt5.QtGui import QPainter, QColor, QBrush, QPixmap, QImage
 from PyQt5.QtCore import Qt, QThread, QObject, pyqtSignal, pyqtSlot
 from os import listdir
-from os.path import isfile, join, isdir
+from os.path import basename, join, isdir
 from numpy import random
 from PIL import Image
 import time
 
+from generator.catalog import Catalog
+
 # side length of displayed images
 PIC_SIDE_CM = 15.24
 # your screen ppi, configure this so the picture size will match your expectations
@@ -16,6 +18,9 @@ PIXELS_PER_INCH = 109
 IMAGES_PATH = './tester_images'
 # how many images from given directory will be used in test
 IMAGES_COUNTS = [(5, 5), (5, 5)]
+# image lists come from the catalogue, which the generator keeps up to date for
+#  the images it writes, set to True after adding or changing images by hand
+REFRESH_CATALOG = False
 
 # display times configuration
 FIXATION_DISPLAY_TIME_S = 1
@@ -38,8 +43,10 @@ class Image:
         return self.guessed_cls == self.cls
 
 class Tester:
-    def __init__(self, images_path, images_counts):
+    def __init__(self, images_path, images_counts, catalog=None, refresh=REFRESH_CATALOG):
         self._images_path = images_path
+        self._catalog = catalog if catalog is not None else Catalog()
+        self._refresh = refresh
         self._last_guessed_index = -1
         directories = [d for d in listdir(
             images_path) if isdir(join(images_path, d))]
@@ -56,7 +63,7 @@ class Tester:
 
     def _collect_images_for_class(self, cls, label, images_count):
         original_dir = join(self._images_path, label)
-        original_images = self._list_image_files(original_dir)
+        original_images = self._list_image_files(original_dir, label, True)
         self._print_image_count(len(original_images), label)
         chosen_original_images = random.choice(
             a=original_images, size=min(images_count[0], len(original_images)), replace=False)
@@ -66,7 +73,7 @@ class Tester:
 
         adv_dir = join(self._images_path, label + '_adv')
         if isdir(adv_dir):
-            adv_images = self._list_image_files(adv_dir)
+            adv_images = self._list_image_files(adv_dir, label, False)
             self._print_image_count(len(adv_images), label + ' adversarial')
             chosen_adv_images = random.choice(
                 a=adv_images, size=min(images_count[1], len(adv_images)), replace=False)
@@ -74,8 +81,13 @@ class Tester:
                 self._chosen_images.append(
                     Image(join(adv_dir, img), cls, False))
 
-    def _list_image_files(self, dir):
-        return [f for f in listdir(dir) if isfile(join(dir, f)) and (f.endswith('.jpg') or f.endswith('.jpeg'))]
+    def _list_image_files(self, dir, label, original):
+        paths = self._catalog.query(label, original, dir)
+        # Directories the catalogue has never seen are scanned once
+        if self._refresh or not paths:
+            self._catalog.sync_directory(dir, label, original)
+            paths = self._catalog.query(label, original, dir)
+        return [basename(path) for path in paths]
 
     def _print_image_count(self, count, label):
         print('{0} {1} images found'.format(count, label))